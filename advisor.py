@@ -0,0 +1,155 @@
+"""advisor.py - exact roll/stop advice for a Zombie Dice turn.
+
+Solves a turn as a dynamic program over (cup colors, pool colors, shots). The
+brains of a turn follow from that state, since every die that left the cup
+and the pool is either a brain or a shot. Once solved, the table answers any
+turn state with a single dict lookup.
+"""
+
+import json
+
+import engine
+
+# bump when the table layout or the rules change, so stored tables are redone
+VERSION = 1
+
+_TOTAL = sum(engine.CUP)
+_PROBS = [[engine.DICE[color].count(face) / 6.0 for face in range(3)]
+          for color in range(3)]
+_TABLE = None
+_FILLS = {}
+_ROLLS = {}
+
+
+def state_key(cup, pool, shots):
+    """Packs cup counts, pool color counts and shots into a table key"""
+    return engine.pack(cup, pool) | shots << 15
+
+
+def pool_counts(pool):
+    """Returns the color counts of an engine pool of slots"""
+    counts = [0, 0, 0]
+    for color in pool:
+        if color != engine.EMPTY:
+            counts[color] += 1
+    return tuple(counts)
+
+
+def _add(dist, key, p):
+    dist[key] = dist.get(key, 0.0) + p
+
+
+def _fills(cup, pool):
+    """Distribution of (cup, pool) after topping the pool up from the cup"""
+    if (cup, pool) in _FILLS:
+        return _FILLS[(cup, pool)]
+    left = sum(cup)
+    if sum(pool) == engine.POOL_SIZE or not left:
+        dist = {(cup, pool): 1.0}
+    else:
+        dist = {}
+        for color in range(3):
+            if not cup[color]:
+                continue
+            c = list(cup)
+            c[color] -= 1
+            p = list(pool)
+            p[color] += 1
+            for k, prob in _fills(tuple(c), tuple(p)).items():
+                _add(dist, k, prob * cup[color] / left)
+    _FILLS[(cup, pool)] = dist
+    return dist
+
+
+def _rolls(pool):
+    """Distribution of (feet, shots) from rolling a pool of color counts"""
+    if pool in _ROLLS:
+        return _ROLLS[pool]
+    dist = {((0, 0, 0), 0): 1.0}
+    for color in range(3):
+        for _ in range(pool[color]):
+            rolled = {}
+            for (feet, shots), prob in dist.items():
+                brain, foot, shot = _PROBS[color]
+                more = list(feet)
+                more[color] += 1
+                _add(rolled, (feet, shots), prob * brain)
+                _add(rolled, (tuple(more), shots), prob * foot)
+                _add(rolled, (feet, shots + 1), prob * shot)
+            dist = rolled
+    _ROLLS[pool] = dist
+    return dist
+
+
+def _solve(table, cup, pool, shots):
+    """Fills table with (value, bust probability, roll value) entries for
+    the state and every state reachable from it. Returns the value."""
+    key = state_key(cup, pool, shots)
+    if key in table:
+        return table[key][0]
+    brains = _TOTAL - sum(cup) - sum(pool) - shots
+    if not sum(cup) and not sum(pool):
+        table[key] = (brains, 0.0, brains)
+        return brains
+    bust = again = rest = 0.0
+    for (c, p), filled in _fills(cup, pool).items():
+        for (feet, hit), rolled in _rolls(p).items():
+            prob = filled * rolled
+            if shots + hit > engine.MAX_SHOTS:
+                bust += prob
+            elif c == cup and feet == pool:
+                # every die came up feet without drawing: same state again
+                again += prob
+            else:
+                rest += prob * _solve(table, c, feet, shots + hit)
+    if rest > brains * (1.0 - again):
+        roll = value = rest / (1.0 - again)
+    else:
+        roll = rest + again * brains
+        value = brains
+    table[key] = (value, bust, roll)
+    return value
+
+
+def solve():
+    """Returns the table for every state reachable from a fresh cup"""
+    table = {}
+    _solve(table, engine.CUP, (0, 0, 0), 0)
+    return table
+
+
+def dumps(table):
+    """Serializes a solved table"""
+    return json.dumps(sorted([key] + list(entry)
+                             for key, entry in table.items()),
+                      separators=(',', ':'))
+
+
+def loads(data):
+    """Rebuilds a table serialized by dumps()"""
+    return dict((row[0], tuple(row[1:])) for row in json.loads(data))
+
+
+def get_table():
+    """Returns the in-process table, or None until one is set or solved"""
+    return _TABLE
+
+
+def set_table(table):
+    global _TABLE
+    _TABLE = table
+
+
+def advise(state):
+    """Returns (bust probability, stop brains, expected brains when rolling
+    and playing on perfectly) for an engine.TurnState."""
+    global _TABLE
+    if _TABLE is None:
+        _TABLE = solve()
+    cup = tuple(state.cup)
+    pool = pool_counts(state.pool)
+    key = state_key(cup, pool, state.shots)
+    if key not in _TABLE:
+        _solve(_TABLE, cup, pool, state.shots)
+    value, bust, roll = _TABLE[key]
+    return bust, state.brains, roll
@@ -5,156 +5,343 @@ as well as the ProtoPRC message class and container required
 for endpoint method definition.
 """
 
+import time
+
 import endpoints
 from protorpc import messages
-from protorpc import message_types
 from protorpc import remote
 
 from models import User, UserForm, UserForms, GameForm, GameForms, NewGameForm
 from models import Game, Turn, TurnForm, TakeTurnForm, TurnForms, StringMessage
+from models import AdviceTable, AdviceForm, TurnActionForms, StatsForm
+from models import stats
 
-from utils import get_by_urlsafe
+import cache
+import instrument
+from utils import get_by_urlsafe, key_from_urlsafe, fetch_page, page_size
 
 __author__ = "danielmcvicker@gmail.com (Daniel McVicker)"
 
+instrument.install()
+
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
+PAGE_REQUEST = endpoints.ResourceContainer(
+    page_size=messages.IntegerField(1, variant=messages.Variant.INT32),
+    cursor=messages.StringField(2))
 USER_REQUEST = endpoints.ResourceContainer(
     user_name=messages.StringField(1),
     email=messages.StringField(2))
 GET_GAME_REQUEST = endpoints.ResourceContainer(
-    urlsafe_game_key=messages.StringField(1),)
+    urlsafe_game_key=messages.StringField(1),
+    since_version=messages.IntegerField(2))
+WAIT_GAME_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    since_version=messages.IntegerField(2),
+    timeout=messages.IntegerField(3, variant=messages.Variant.INT32))
 TAKE_TURN_REQUEST = endpoints.ResourceContainer(
     TakeTurnForm,
     urlsafe_turn_key=messages.StringField(1))
-USER_GAMES_REQUEST = endpoints.ResourceContainer(
+TURN_ADVICE_REQUEST = endpoints.ResourceContainer(
+    urlsafe_turn_key=messages.StringField(1),)
+USER_RANK_REQUEST = endpoints.ResourceContainer(
     user_name=messages.StringField(1),)
+USER_GAMES_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    page_size=messages.IntegerField(2, variant=messages.Variant.INT32),
+    cursor=messages.StringField(3))
+STATS_REQUEST = endpoints.ResourceContainer(
+    days=messages.IntegerField(1, variant=messages.Variant.INT32),
+    user_name=messages.StringField(2),
+    opponent=messages.StringField(3))
 CANCEL_GAME_REQUEST = endpoints.ResourceContainer(
     urlsafe_game_key=messages.StringField(1),)
 GAME_HISTORY_REQUEST = endpoints.ResourceContainer(
-    urlsafe_game_key=messages.StringField(1),)
+    urlsafe_game_key=messages.StringField(1),
+    page_size=messages.IntegerField(2, variant=messages.Variant.INT32),
+    cursor=messages.StringField(3))
+
+
+# most rolls a single take_turn call will make
+MAX_ROLLS = 50
+# most actions a single take_turns call will apply
+MAX_ACTIONS = 100
+# longest a wait_game call blocks, in seconds, well inside the deadline
+MAX_WAIT = 20
+# seconds between checks of a game's version while waiting
+WAIT_INTERVAL = 0.5
+
+
+def max_rolls(request):
+    """Returns how many times a TakeTurnForm asks to roll"""
+    if request.max_rolls is not None:
+        if request.max_rolls < 1:
+            raise endpoints.BadRequestException('max_rolls must be positive')
+        return min(request.max_rolls, MAX_ROLLS)
+    if request.until_brains is not None or request.until_shots is not None:
+        return MAX_ROLLS
+    return 1
+
+
+def game_form(urlsafe_game_key, since):
+    """Returns a not_modified GameForm when the game is still at
+    version since, reading only its version, and the full GameForm
+    otherwise"""
+    key = key_from_urlsafe(urlsafe_game_key)
+    if since is not None:
+        version = Game.current_version(key)
+        if version == since:
+            return GameForm(urlsafe_key=urlsafe_game_key,
+                            version=version, not_modified=True)
+    game = cache.get(key)
+    if not isinstance(game, Game):
+        raise endpoints.NotFoundException('Game not found!')
+    return game.to_form()
 
 
 @endpoints.api(name='zombiedice', version='v0.1')
 class ZombieDiceApi(remote.Service):
     """Game API for the Zombie Dice game"""
 
-    @endpoints.method(request_message=message_types.VoidMessage, 
+    @endpoints.method(request_message=PAGE_REQUEST,
                       response_message=UserForms,
                       path='users', 
                       http_method='GET', 
                       name='get_users')
+    @instrument.instrumented()
     def get_users(self, request):
-        """Return all Users, including ones who haven't played any Games"""
-        users = User.query().fetch()
-        return UserForms(items=[user.to_form() for user in users])
+        """Return a page of Users, including ones who haven't played any
+        Games"""
+        users, cursor = fetch_page(User.query(), request.page_size,
+                                   request.cursor)
+        return UserForms(items=User.to_forms(users), next_cursor=cursor)
 
     @endpoints.method(request_message=USER_REQUEST,
                       response_message=StringMessage,
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @instrument.instrumented()
     def create_user(self, request):
         """Create a User with a unique username."""
-        if User.query(User.name == request.user_name).get():
-            raise endpoints.ConflictException(
-                'A User with that name already exists.')
-        user = User(name=request.user_name, email=request.email)
-        user.put()
-        return StringMessage(message='User {} created!'.format(
+        if not request.user_name or not User.normalize(request.user_name):
+            raise endpoints.BadRequestException('A user_name is required')
+        try:
+            User.create(request.user_name, request.email)
+        except ValueError as e:
+            raise endpoints.ConflictException(str(e))
+        return StringMessage(message=u'User {} created!'.format(
             request.user_name))
 
-    @endpoints.method(response_message=UserForms,
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=UserForms,
                       path='user/ranking',
                       name='get_user_rankings',
                       http_method='GET')
+    @instrument.instrumented()
     def get_user_rankings(self, request):
-        """Return all Users, sorted by win percentage"""
-        users = User.query(User.total_played > 0).fetch()
-        users = sorted(users, key=lambda x: x.win_percentage, reverse=True)
-        return UserForms(items=[user.to_form() for user in users])
+        """Return a page of ranked Users, sorted by win percentage"""
+        users, cursor = fetch_page(User.rankings(), request.page_size,
+                                   request.cursor)
+        ranks = User.ranks(users)
+        return UserForms(items=User.to_forms(users, ranks),
+                         next_cursor=cursor)
+
+    @endpoints.method(request_message=USER_RANK_REQUEST,
+                      response_message=UserForm,
+                      path='user/rank/{user_name}',
+                      name='get_user_rank',
+                      http_method='GET')
+    @instrument.instrumented()
+    def get_user_rank(self, request):
+        """Return a User with their rank, which is empty until they have
+        played enough games to be ranked"""
+        user = User.get_by_names([request.user_name])[0]
+        if not user:
+            raise endpoints.NotFoundException(
+                'That username does not exist!')
+        return user.to_form(User.ranks([user])[0])
 
     @endpoints.method(request_message=NEW_GAME_REQUEST,
                       response_message=GameForm,
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @instrument.instrumented()
     def new_game(self, request):
         """Creates new game"""
-        players = []
-        for player in request.players:
-            # get the full user data for the player
-            user = User.query(User.name == player).get()
-            if not user:
-                raise endpoints.NotFoundException(
-                    'One or more of those usernames does not exist!')
-            # append the key to the list of players
-            players.append(user.key)
+        users = User.get_by_names(request.players)
+        if not all(users):
+            raise endpoints.NotFoundException(
+                'One or more of those usernames does not exist!')
 
-        game = Game.new_game(players)
+        game = Game.new_game([user.key for user in users],
+                             [user.name for user in users])
 
         return game.to_form()
 
+    def since_version(self, request):
+        """The version the client already has, from since_version or an
+        If-None-Match header"""
+        if request.since_version is not None:
+            return request.since_version
+        etag = self.request_state.headers.get('If-None-Match', '')
+        etag = etag.replace('W/', '').strip('" ')
+        if etag.isdigit():
+            return int(etag)
+        return None
+
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @instrument.instrumented()
     def get_game(self, request):
-        """Return the current game state."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game:
-            return game.to_form()
-        else:
-            raise endpoints.NotFoundException('Game not found!')
+        """Return the current game state. With since_version (or an
+        If-None-Match header) set to the version the client has, an
+        unchanged game is answered with not_modified from memcache."""
+        return game_form(request.urlsafe_game_key,
+                         self.since_version(request))
+
+    @endpoints.method(request_message=WAIT_GAME_REQUEST,
+                      response_message=GameForm,
+                      path='game/{urlsafe_game_key}/wait',
+                      name='wait_game',
+                      http_method='GET')
+    @instrument.instrumented()
+    def wait_game(self, request):
+        """Waits up to timeout seconds (at most MAX_WAIT) for the game to
+        move past since_version, then returns it like get_game does."""
+        since = self.since_version(request)
+        key = key_from_urlsafe(request.urlsafe_game_key)
+        if since is not None:
+            timeout = min(request.timeout or MAX_WAIT, MAX_WAIT)
+            deadline = time.time() + timeout
+            while (Game.current_version(key) == since and
+                   time.time() < deadline):
+                time.sleep(WAIT_INTERVAL)
+        return game_form(request.urlsafe_game_key, since)
 
     @endpoints.method(request_message=TAKE_TURN_REQUEST,
                       response_message=TurnForm,
                       path='turn/{urlsafe_turn_key}',
                       name='take_turn',
                       http_method='PUT')
+    @instrument.instrumented()
     def take_turn(self, request):
         """Takes a turn. Returns the turn state with message."""
-        turn = get_by_urlsafe(request.urlsafe_turn_key, Turn)
+        turn = Turn.load(key_from_urlsafe(request.urlsafe_turn_key))
         if not turn:
-            raise endpoints.NotFoundException('Turn not found')
+            # finished turns only live on in their game's history
+            raise endpoints.NotFoundException('Turn not found or over')
         if turn.turn_over:
             raise endpoints.BadRequestException('This turn is over!')
 
-        if request.roll:
-            return turn.take_turn()
-        else:
-            turn.end_turn()
+        try:
+            if request.roll:
+                if not turn.state.can_roll:
+                    raise endpoints.BadRequestException(
+                        'No dice left to roll!')
+                return turn.take_turn(max_rolls(request),
+                                      request.until_brains,
+                                      request.until_shots,
+                                      request.stop)
+            else:
+                return turn.end_turn()
+        except ValueError as e:
+            # another request changed or ended this turn first
+            raise endpoints.BadRequestException(str(e))
+
+    @endpoints.method(request_message=TurnActionForms,
+                      response_message=TurnForms,
+                      path='turns',
+                      name='take_turns',
+                      http_method='PUT')
+    @instrument.instrumented()
+    def take_turns(self, request):
+        """Rolls or ends many turns at once, usually in different games.
+        Returns a TurnForm per action, in order; actions that failed have
+        their error set."""
+        if len(request.items) > MAX_ACTIONS:
+            raise endpoints.BadRequestException(
+                'At most {} actions per batch'.format(MAX_ACTIONS))
+        actions = [(item.urlsafe_turn_key, item.roll)
+                   for item in request.items]
+        return TurnForms(items=Turn.take_turns(actions))
 
-            return turn.to_form()
+    @endpoints.method(request_message=TURN_ADVICE_REQUEST,
+                      response_message=AdviceForm,
+                      path='turn/{urlsafe_turn_key}/advice',
+                      name='get_turn_advice',
+                      http_method='GET')
+    @instrument.instrumented()
+    def get_turn_advice(self, request):
+        """Returns the chance of busting on the next roll and the expected
+        brains from rolling on versus stopping now."""
+        turn = Turn.load(key_from_urlsafe(request.urlsafe_turn_key))
+        if not turn:
+            # finished turns only live on in their game's history
+            raise endpoints.NotFoundException('Turn not found or over')
+        if turn.turn_over:
+            raise endpoints.BadRequestException('This turn is over!')
+        AdviceTable.load()
+        return turn.advise()
 
     @endpoints.method(request_message=USER_GAMES_REQUEST,
                       response_message=GameForms,
                       path='user/games/{user_name}',
                       name='get_user_games',
                       http_method='GET')
+    @instrument.instrumented()
     def get_user_games(self, request):
-        """Return all Games the user has played or is playing. """
-        user = User.query(User.name == request.user_name).get()
+        """Return a page of the Games the user has played or is playing. """
+        user = User.get_by_names([request.user_name])[0]
         if not user:
             raise endpoints.NotFoundException(
                 'That username does not exist!')
-        games = Game.query(Game.players == user.key)
-        return GameForms(items=[game.to_form() for game in games])
+        games, cursor = fetch_page(Game.query(Game.players == user.key),
+                                   request.page_size, request.cursor)
+        return GameForms(items=Game.to_forms(games), next_cursor=cursor)
         
+    @endpoints.method(request_message=STATS_REQUEST,
+                      response_message=StatsForm,
+                      path='stats',
+                      name='get_stats',
+                      http_method='GET')
+    @instrument.instrumented()
+    def get_stats(self, request):
+        """Return the games finished and their average length for each of
+        the last `days` days (7 by default), and with user_name set, the
+        user's totals and record against opponent. Served from rolled up
+        counters only."""
+        if request.days is not None and request.days < 1:
+            raise endpoints.BadRequestException('days must be positive')
+        user = opponent = None
+        if request.user_name:
+            names = [request.user_name]
+            if request.opponent:
+                names.append(request.opponent)
+            users = User.get_by_names(names)
+            if not all(users):
+                raise endpoints.NotFoundException(
+                    'One or more of those usernames does not exist!')
+            user = users[0]
+            if request.opponent:
+                opponent = users[1]
+        return stats.get_stats(request.days or 7, user=user,
+                               opponent=opponent)
+
     @endpoints.method(request_message=CANCEL_GAME_REQUEST,
                       response_message=StringMessage,
                       path='game/{urlsafe_game_key}',
                       name='cancel_game',
                       http_method='DELETE')
+    @instrument.instrumented()
     def cancel_game(self, request):
         """Delete a Game in progress. Games that are over cannot be deleted."""
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
         if game and not game.game_over:
-            # first delete all child turns
-            turns = Turn.query(ancestor=game.key).fetch()
-            for turn in turns:
-                turn.key.delete()
-            game.key.delete()
+            game.delete()
             return StringMessage(message='Game with key: {} deleted.'.
                                  format(request.urlsafe_game_key))
         elif game and game.game_over:
@@ -167,11 +354,33 @@ class ZombieDiceApi(remote.Service):
                       path='game/history/{urlsafe_game_key}',
                       name='get_game_history',
                       http_method='GET')
+    @instrument.instrumented()
     def get_game_history(self, request):
-        """Return all Turns for a given game. """
+        """Return a page of the Turns for a given game. """
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        turns = Turn.query(ancestor=game.key).fetch()
-        return TurnForms(items=[turn.to_form() for turn in turns])
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        if game.seed is None:
+            # games from before the decision log keep every Turn entity
+            turns, cursor = fetch_page(Turn.query(ancestor=game.key),
+                                       request.page_size, request.cursor)
+            return TurnForms(items=Turn.to_forms(turns), next_cursor=cursor)
+        try:
+            offset = int(request.cursor or 0)
+        except ValueError:
+            raise endpoints.BadRequestException('Invalid cursor')
+        turns, offset = game.history(offset, page_size(request.page_size))
+        cursor = None
+        if offset is not None:
+            cursor = str(offset)
+        return TurnForms(items=Turn.to_forms(turns), next_cursor=cursor)
 
 
 APPLICATION = endpoints.api_server([ZombieDiceApi])
+
+
+def warm_up():
+    """Does the work the first requests to a new instance would otherwise
+    wait for, beyond importing this module, which already builds and
+    registers the API config: loads the advisor table"""
+    AdviceTable.load()
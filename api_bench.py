@@ -0,0 +1,253 @@
+"""api_bench.py - benchmark of ZombieDiceApi against local testbed stubs.
+
+Runs a scripted workload through the endpoint methods with the testbed's
+datastore, memcache, mail and taskqueue stubs in place of the live services:
+creating users, playing games of 2 to 8 players to the end, reading their
+histories and reading the rankings. Reports p50/p99 latency, datastore RPCs
+and entity bytes written per call of each endpoint, as counted by
+instrument.py. Games are seeded, so two runs play the same dice and the
+results of two commits can be compared.
+
+    python api_bench.py --sdk ~/google_appengine --out before.json
+    python api_bench.py --sdk ~/google_appengine --compare before.json
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# highest number of turns a benchmark game is played for
+MAX_TURNS = 500
+
+
+def add_sdk(sdk):
+    """Puts the SDK and its bundled libraries on the path"""
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+
+
+def setup(sdk):
+    """Puts the SDK on the path and activates the testbed stubs. Returns
+    the testbed"""
+    add_sdk(sdk)
+    return activate_stubs()
+
+
+def activate_stubs():
+    """Activates the testbed stubs. Returns the testbed"""
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    # endpoints reads the app revision after the dot of the version id
+    bed.setup_env(current_version_id='testbed.1', overwrite=True)
+    # fully consistent, so index queries see what the workload just wrote
+    bed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.
+        PseudoRandomHRConsistencyPolicy(probability=1))
+    bed.init_memcache_stub()
+    bed.init_mail_stub()
+    bed.init_app_identity_stub()
+    bed.init_taskqueue_stub(root_path=HERE)
+    return bed
+
+
+class Bench(object):
+    """Calls endpoint methods and records the spans instrument.py logs for
+    each of them"""
+
+    def __init__(self, bed):
+        import api
+        import instrument
+        import main
+        from protorpc import remote
+
+        self.api = api
+        self.main = main
+        self.service = api.ZombieDiceApi()
+        self.service.initialize_request_state(
+            remote.HttpRequestState(headers={}))
+        self.taskqueue = bed.get_stub('taskqueue')
+        self.results = {}
+        self.spans = []
+        instrument.add_listener(self.spans.extend)
+
+    def call(self, name, request_type, **fields):
+        """Calls the endpoint method `name` and records its span"""
+        request = getattr(request_type, 'combined_message_class',
+                          request_type)(**fields)
+        del self.spans[:]
+        try:
+            return getattr(self.service, name)(request)
+        finally:
+            for span in self.spans:
+                if span['name'] == name:
+                    self.results.setdefault(name, []).append(span)
+
+    def run_tasks(self):
+        """Runs the push tasks queued so far through main.app, as the task
+        queue would, including the ones they queue"""
+        # the stub reports pull tasks as POSTs, so go by the queue's mode
+        queues = [queue['name'] for queue in self.taskqueue.GetQueues()
+                  if queue['mode'] == 'push']
+        while True:
+            tasks = [(queue, task) for queue in queues
+                     for task in self.taskqueue.get_filtered_tasks(
+                         queue_names=[queue])]
+            if not tasks:
+                return
+            for queue, task in tasks:
+                self.taskqueue.DeleteTask(queue, task.name)
+                response = self.main.app.get_response(
+                    task.url, method=task.method, body=task.payload,
+                    headers=task.headers)
+                if response.status_int != 200:
+                    raise RuntimeError('{} failed: {}'.format(
+                        task.url, response.status))
+
+    def create_users(self, count):
+        names = ['player{}'.format(i) for i in range(count)]
+        for name in names:
+            self.call('create_user', self.api.USER_REQUEST, user_name=name)
+        return names
+
+    def play_game(self, players):
+        """Plays a game to the end, rolling while the turn has fewer than
+        two shots and five brains. Returns the urlsafe game key"""
+        api = self.api
+        game = self.call('new_game', api.NEW_GAME_REQUEST, players=players)
+        key = game.urlsafe_key
+        version = game.version
+        for _ in range(MAX_TURNS):
+            if game.game_over:
+                break
+            turn_key = game.next_turn_key
+            turn = self.call('take_turn', api.TAKE_TURN_REQUEST,
+                             urlsafe_turn_key=turn_key, roll=True)
+            while not turn.turn_over:
+                roll = turn.shots < 2 and turn.brains < 5
+                turn = self.call('take_turn', api.TAKE_TURN_REQUEST,
+                                 urlsafe_turn_key=turn_key, roll=roll)
+            # a poller that is up to date gets not_modified
+            self.call('get_game', api.GET_GAME_REQUEST,
+                      urlsafe_game_key=key, since_version=version)
+            game = self.call('get_game', api.GET_GAME_REQUEST,
+                             urlsafe_game_key=key)
+            version = game.version
+        return key
+
+    def read_history(self, key):
+        cursor = None
+        while True:
+            turns = self.call('get_game_history',
+                              self.api.GAME_HISTORY_REQUEST,
+                              urlsafe_game_key=key, cursor=cursor)
+            cursor = turns.next_cursor
+            if not cursor:
+                return
+
+    def read_rankings(self, names):
+        self.call('get_user_rankings', self.api.PAGE_REQUEST)
+        for name in names:
+            self.call('get_user_rank', self.api.USER_RANK_REQUEST,
+                      user_name=name)
+
+    def run(self, games):
+        names = self.create_users(8)
+        keys = []
+        for i in range(games):
+            players = names[:2 + i % 7]
+            keys.append(self.play_game(players))
+        self.run_tasks()
+        for key in keys:
+            self.read_history(key)
+        self.read_rankings(names)
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def report(results):
+    """Returns the per-endpoint summary of the recorded spans"""
+    summary = {}
+    for name, spans in results.items():
+        calls = float(len(spans))
+        rpcs = {}
+        for span in spans:
+            for kind, count in span['rpcs'].items():
+                rpcs[kind] = rpcs.get(kind, 0) + count
+        summary[name] = {
+            'calls': len(spans),
+            'p50_ms': _percentile([span['ms'] for span in spans], 0.5),
+            'p99_ms': _percentile([span['ms'] for span in spans], 0.99),
+            'datastore_rpcs': round(sum(
+                count for kind, count in rpcs.items()
+                if kind not in ('memcache', 'taskqueue', 'other')) / calls,
+                2),
+            'rpcs': dict((kind, round(count / calls, 2))
+                         for kind, count in rpcs.items()),
+            'bytes_written': int(sum(span['bytes_written']
+                                     for span in spans) / calls),
+        }
+    return summary
+
+
+def compare(before, after):
+    """Prints the change in each endpoint's numbers between two reports"""
+    row = '{:<20} {:>16} {:>16} {:>16} {:>18}'
+    print(row.format('endpoint', 'p50 ms', 'p99 ms', 'datastore rpcs',
+                     'bytes written'))
+    for name in sorted(set(before) | set(after)):
+        old = before.get(name, {})
+        new = after.get(name, {})
+        cells = []
+        for field in ('p50_ms', 'p99_ms', 'datastore_rpcs',
+                      'bytes_written'):
+            cells.append('{} -> {}'.format(old.get(field, '-'),
+                                           new.get(field, '-')))
+        print(row.format(name, *cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', required=True,
+                        help='path of the App Engine Python SDK')
+    parser.add_argument('--games', type=int, default=14,
+                        help='games to play, cycling through 2-8 players')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help='write the report to this file')
+    parser.add_argument('--compare', help='report of an earlier run')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    bed = setup(args.sdk)
+    try:
+        bench = Bench(bed)
+        start = time.time()
+        bench.run(args.games)
+        elapsed = time.time() - start
+    finally:
+        bed.deactivate()
+
+    summary = report(bench.results)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), summary)
+    else:
+        print(json.dumps(summary, indent=2, sort_keys=True))
+    print('{} games in {:.1f}s'.format(args.games, elapsed))
+
+
+if __name__ == '__main__':
+    main()
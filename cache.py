@@ -0,0 +1,170 @@
+"""cache.py - two-tier read cache for hot entities.
+
+The first tier is a bounded LRU in each instance, the second a version number
+per key in memcache. Writes bump the version (see invalidate()), so a cached
+entity is only used while its version is still current: a hit costs one
+memcache read instead of a datastore get. Entities are cached as protocol
+buffers and rebuilt on every hit, so requests never share an instance.
+
+User names never change once a User exists, so they are cached in their own
+LRU without any version check. Models read through the cache derive from
+CachedModel.
+"""
+
+import collections
+import random
+import threading
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+MAX_ENTITIES = 1000
+MAX_NAMES = 10000
+
+_stats = collections.defaultdict(int)
+_adapter = ndb.ModelAdapter()
+
+
+class LRU(object):
+    """A dict that drops its least recently used items beyond size"""
+
+    def __init__(self, size):
+        self.size = size
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            value = self._items.pop(key)
+            self._items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def __len__(self):
+        return len(self._items)
+
+
+_entities = LRU(MAX_ENTITIES)
+_names = LRU(MAX_NAMES)
+
+
+def _version_key(key):
+    return 'cache-version:' + key.urlsafe()
+
+
+def _new_version():
+    # a random start, so versions from before a memcache eviction can't
+    # match the ones after it
+    return random.getrandbits(31)
+
+
+def invalidate(key):
+    """Marks every cached copy of the entity stale. Call after it is
+    written or deleted"""
+    _entities.pop(key)
+    memcache.incr(_version_key(key), initial_value=_new_version())
+
+
+def invalidate_on_commit(key):
+    """Calls invalidate once the caller's transaction commits, or right
+    away outside of one"""
+    if ndb.in_transaction():
+        ndb.get_context().call_on_commit(lambda: invalidate(key))
+    else:
+        invalidate(key)
+
+
+class CachedModel(ndb.Model):
+    """Base class of the models read through the cache. Their writes and
+    deletes invalidate the cached copies"""
+
+    def _pre_put_hook(self):
+        if ndb.in_transaction():
+            invalidate_on_commit(self.key)
+
+    def _post_put_hook(self, future):
+        if not ndb.in_transaction() and not future.get_exception():
+            invalidate(self.key)
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        invalidate(key)
+
+
+def get_multi(keys):
+    """Returns the entities for a list of keys like ndb.get_multi, taking
+    the ones whose cached version is current from the LRU. Costs one
+    memcache read, plus one get_multi for the rest. Must not be used for
+    reads inside a transaction"""
+    versions = memcache.get_multi([_version_key(key) for key in keys])
+    unversioned = dict((_version_key(key), _new_version()) for key in keys
+                       if _version_key(key) not in versions)
+    if unversioned:
+        # where a writer got there first, the entity is not cached
+        failed = set(memcache.add_multi(unversioned))
+        versions.update((name, version)
+                        for name, version in unversioned.items()
+                        if name not in failed)
+    missing = dict((key, versions.get(_version_key(key))) for key in keys)
+    results = {}
+    for key, version in list(missing.items()):
+        cached = _entities.get(key)
+        if cached is not None and version is not None and \
+                cached[0] == version:
+            results[key] = _adapter.pb_to_entity(cached[1])
+            del missing[key]
+    _stats['entity_hits'] += len(results)
+    _stats['entity_misses'] += len(missing)
+
+    fetched = ndb.get_multi(list(missing))
+    for key, entity in zip(list(missing), fetched):
+        results[key] = entity
+        if entity is not None and missing[key] is not None:
+            _entities.set(key, (missing[key], _adapter.entity_to_pb(entity)))
+    return [results[key] for key in keys]
+
+
+def get(key):
+    return get_multi([key])[0]
+
+
+def get_names(keys, fetch=ndb.get_multi):
+    """Returns a dict mapping User keys to their names, reading the ones
+    not cached in this instance with a single get_multi"""
+    keys = set(key for key in keys if key is not None)
+    names = {}
+    missing = []
+    for key in keys:
+        name = _names.get(key)
+        if name is None:
+            missing.append(key)
+        else:
+            names[key] = name
+    _stats['name_hits'] += len(names)
+    _stats['name_misses'] += len(missing)
+    for key, user in zip(missing, fetch(missing) if missing else []):
+        if user is not None:
+            names[key] = user.name
+            _names.set(key, user.name)
+    return names
+
+
+def stats():
+    """Returns the hit and miss counts and sizes of this instance's
+    caches"""
+    report = dict(_stats)
+    report['entities'] = len(_entities)
+    report['names'] = len(_names)
+    return report
@@ -0,0 +1,206 @@
+"""engine.py - datastore-free dice engine for the Zombie Dice game.
+
+Holds the state of a single turn as plain integers so that it can be rolled,
+stored and benchmarked without the App Engine SDK. The cup is kept as three
+color counts, the pool as a fixed-size array of color slots and the die faces
+as shared constant tables.
+"""
+
+import random
+
+GREEN, YELLOW, RED = 0, 1, 2
+COLORS = ("green", "yellow", "red")
+
+BRAIN, FOOT, SHOT = 0, 1, 2
+FACES = ("brain", "foot", "shot")
+
+# the six faces of each die, indexed by color
+DICE = ((BRAIN, BRAIN, BRAIN, FOOT, FOOT, SHOT),
+        (BRAIN, BRAIN, FOOT, FOOT, SHOT, SHOT),
+        (BRAIN, FOOT, FOOT, SHOT, SHOT, SHOT))
+
+# six green, four yellow and three red dice start in the cup
+CUP = (6, 4, 3)
+POOL_SIZE = 3
+EMPTY = 3  # marks an empty pool slot
+MAX_SHOTS = 2  # a third shot ends the turn with no brains
+WINNING_SCORE = 13  # brains that start the final round
+
+# packed layout: three 3-bit cup counts followed by three 2-bit pool slots
+_CUP_BITS = 3
+_POOL_BITS = 2
+_POOL_SHIFT = _CUP_BITS * len(CUP)
+
+
+def pack(cup, pool):
+    """Packs the cup counts and pool slots into a single integer"""
+    value = 0
+    for i, count in enumerate(cup):
+        value |= count << (i * _CUP_BITS)
+    for i, color in enumerate(pool):
+        value |= color << (_POOL_SHIFT + i * _POOL_BITS)
+    return value
+
+
+def unpack(value):
+    """Unpacks an integer made by pack() into (cup, pool) lists"""
+    cup = [(value >> (i * _CUP_BITS)) & 7 for i in range(len(CUP))]
+    pool = [(value >> (_POOL_SHIFT + i * _POOL_BITS)) & 3
+            for i in range(POOL_SIZE)]
+    return cup, pool
+
+
+START = pack(CUP, (EMPTY,) * POOL_SIZE)
+
+_MASK = (1 << 64) - 1
+
+
+class Rng(object):
+    """Small deterministic generator (splitmix64). Used instead of the
+    random module wherever rolls have to be replayed, since it gives the
+    same numbers on every Python version"""
+    __slots__ = ("state",)
+
+    def __init__(self, seed):
+        self.state = seed & _MASK
+
+    def next(self):
+        self.state = (self.state + 0x9E3779B97F4A7C15) & _MASK
+        z = self.state
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK
+        return z ^ (z >> 31)
+
+    def randrange(self, n):
+        return self.next() % n
+
+
+class TurnState(object):
+    """The dice, brains and shots of a single turn"""
+    __slots__ = ("cup", "pool", "used", "brains", "shots")
+
+    def __init__(self, dice=START, used=(0, 0, 0), brains=0, shots=0):
+        self.cup, self.pool = unpack(dice)
+        self.used = list(used)
+        self.brains = brains
+        self.shots = shots
+
+    @property
+    def dice(self):
+        """The packed cup and pool, as stored on a Turn"""
+        return pack(self.cup, self.pool)
+
+    @property
+    def busted(self):
+        return self.shots > MAX_SHOTS
+
+    @property
+    def can_roll(self):
+        """False once the cup and the pool have both run dry"""
+        return sum(self.cup) > 0 or any(c != EMPTY for c in self.pool)
+
+    def pool_names(self):
+        """Returns the colors of the dice waiting in the pool"""
+        return [COLORS[c] for c in self.pool if c != EMPTY]
+
+    def roll(self, rng=random):
+        """Fills the pool from the cup and rolls it. Returns the results of
+        the roll as a list of (color, face) pairs."""
+        if not self.can_roll:
+            raise ValueError("No dice left to roll")
+        cup = self.cup
+        pool = self.pool
+        results = []
+        for slot in range(POOL_SIZE):
+            # draw a random die from the cup for every empty slot
+            if pool[slot] == EMPTY:
+                left = cup[GREEN] + cup[YELLOW] + cup[RED]
+                if not left:
+                    continue
+                pick = rng.randrange(left)
+                color = GREEN
+                while pick >= cup[color]:
+                    pick -= cup[color]
+                    color += 1
+                cup[color] -= 1
+                pool[slot] = color
+            color = pool[slot]
+            face = DICE[color][rng.randrange(6)]
+            results.append((color, face))
+            # brains and shots are set aside, feet stay in the pool
+            if face == FOOT:
+                continue
+            if face == BRAIN:
+                self.brains += 1
+            else:
+                self.shots += 1
+            self.used[color] += 1
+            pool[slot] = EMPTY
+        # If shots on the current turn are 3 or more, the brains are lost.
+        if self.busted:
+            self.brains = 0
+        return results
+
+
+def roll_rng(seed, number, index):
+    """Returns the generator for roll `index` of turn `number` of the game
+    with the given seed. Each roll gets its own generator, so a roll can be
+    made without replaying the rolls before it"""
+    return Rng(seed ^ (((number << 16) | index) * 0xD1B54A32D192ED03))
+
+
+def replay_turn(seed, number, rolls):
+    """Rebuilds the TurnState of a turn from the number of rolls taken"""
+    state = TurnState()
+    for index in range(rolls):
+        state.roll(roll_rng(seed, number, index))
+    return state
+
+
+def append_log(log, rolls):
+    """Appends the number of rolls of a finished turn to a game log. Each
+    turn is stored as a varint, so a turn of under 128 rolls takes a byte"""
+    log = bytearray(log or b"")
+    while rolls >= 0x80:
+        log.append(rolls & 0x7F | 0x80)
+        rolls >>= 7
+    log.append(rolls)
+    return bytes(log)
+
+
+def read_log(log):
+    """Yields the number of rolls of every turn in a game log"""
+    rolls = shift = 0
+    for byte in bytearray(log or b""):
+        rolls |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            yield rolls
+            rolls = shift = 0
+
+
+def score_turn(scores, seat, brains, shots, final_seat):
+    """Applies a finished turn to the list of game scores, one per seat.
+    Scoring 13 or more brains makes the previous seat the final player, and
+    the game ends once the final player has scored.
+    Returns:
+        A (final_seat, winner_seat) tuple. Either one is None while unset.
+    """
+    winner = None
+    # only score if player didn't die from 3 or more shots
+    if shots <= MAX_SHOTS:
+        scores[seat] += brains
+        if seat == final_seat:
+            winner = scores.index(max(scores))
+        if scores[seat] >= WINNING_SCORE:
+            final_seat = (seat - 1) % len(scores)
+    return final_seat, winner
+
+
+if __name__ == "__main__":
+    import timeit
+    n = 100000
+    seconds = timeit.timeit(
+        "state = TurnState(); state.roll()",
+        setup="from engine import TurnState", number=n)
+    print("{:.0f} rolls/s".format(n / seconds))
@@ -0,0 +1,278 @@
+"""instrument.py - per-request RPC and latency instrumentation.
+
+Hooks the API proxy to count every RPC a request makes, by kind, along with
+the bytes sent, received and written and the time spent waiting.
+instrumented() wraps endpoint methods and hot model methods in named spans:
+each span is checked against its RPC budget, and the spans of a request are
+logged as one JSON line and added to per-minute histograms in memcache, so
+stats() can report on every instance.
+"""
+
+import functools
+import json
+import logging
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map, memcache
+
+# upper bounds of the latency histogram buckets, in milliseconds
+BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+# kinds of RPC counted, see _kind()
+KINDS = ('get', 'put', 'delete', 'query', 'txn', 'allocate', 'memcache',
+         'taskqueue', 'other')
+_DATASTORE_KINDS = {
+    'Get': 'get', 'Put': 'put', 'Delete': 'delete',
+    'RunQuery': 'query', 'Next': 'query', 'Count': 'query',
+    'BeginTransaction': 'txn', 'Commit': 'txn', 'Rollback': 'txn',
+    'AllocateIds': 'allocate'}
+# most datastore RPCs a span may make before it is logged as over budget,
+# None for no limit
+DEFAULT_BUDGET = 10
+BUDGETS = {
+    'get_game': 2,
+    'wait_game': 2,
+    'new_game': 3,
+    'take_turn': 8,
+    'take_turns': None,  # grows with the number of games in the batch
+    'create_user': 5,  # a query for a legacy User with the name
+    'get_user_rank': 3,
+    'get_user_rankings': 25,
+    'Game.to_forms': 1,
+    'Game.end_turn': 1,  # an allocate_ids for games without a seed
+}
+# raise BudgetExceeded instead of only logging, for benchmarks and tests
+STRICT_BUDGETS = False
+# minutes of histograms stats() reads by default
+WINDOW = 15
+
+_local = threading.local()
+_NAMES = set()
+# spans are only measured once the hooks are installed, so offline code
+# running the models without any services pays nothing
+_installed = False
+_LISTENERS = []
+
+
+class BudgetExceeded(Exception):
+    """A span made more datastore RPCs than its budget allows"""
+
+
+def _kind(service, call):
+    if service == 'datastore_v3':
+        return _DATASTORE_KINDS.get(call, 'other')
+    if service in ('memcache', 'taskqueue'):
+        return service
+    return 'other'
+
+
+def _pre_call(service, call, request, response):
+    if getattr(_local, 'rpcs', None) is None:
+        return
+    _local.starts[id(request)] = time.time()
+
+
+def _post_call(service, call, request, response, rpc=None, error=None):
+    if getattr(_local, 'rpcs', None) is None:
+        return
+    rpcs = _local.rpcs
+    kind = _kind(service, call)
+    rpcs[kind] = rpcs.get(kind, 0) + 1
+    start = _local.starts.pop(id(request), None)
+    if start is not None:
+        _local.rpc_ms += (time.time() - start) * 1000
+    try:
+        _local.sent += request.ByteSize()
+        if kind == 'put':
+            _local.written += request.ByteSize()
+        if error is None:
+            _local.received += response.ByteSize()
+    except AttributeError:
+        pass
+
+
+def install():
+    """Adds the RPC hooks to the API proxy. Safe to call more than once"""
+    global _installed
+    _installed = True
+    apiproxy = apiproxy_stub_map.apiproxy
+    apiproxy.GetPreCallHooks().Append('instrument', _pre_call)
+    apiproxy.GetPostCallHooks().Append('instrument', _post_call)
+
+
+def add_listener(listener):
+    """Calls listener with the list of spans of every finished request"""
+    _LISTENERS.append(listener)
+
+
+def _snapshot():
+    return (dict(_local.rpcs), _local.sent, _local.received,
+            _local.written, _local.rpc_ms)
+
+
+def _delta(before):
+    rpcs, sent, received, written, rpc_ms = before
+    return (dict((kind, count - rpcs.get(kind, 0))
+                 for kind, count in _local.rpcs.items()
+                 if count > rpcs.get(kind, 0)),
+            _local.sent - sent, _local.received - received,
+            _local.written - written, _local.rpc_ms - rpc_ms)
+
+
+def _datastore_rpcs(rpcs):
+    return sum(count for kind, count in rpcs.items()
+               if kind not in ('memcache', 'taskqueue', 'other'))
+
+
+def _over_budget(name, rpcs):
+    budget = BUDGETS.get(name, DEFAULT_BUDGET)
+    return budget is not None and _datastore_rpcs(rpcs) > budget
+
+
+def instrumented(name=None):
+    """Decorator that measures each call of a function as a span called
+    name, the function's name by default. The outermost span of a request
+    logs and publishes all of them once it finishes"""
+    def decorator(func):
+        span_name = name or func.__name__
+        _NAMES.add(span_name)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _installed:
+                return func(*args, **kwargs)
+            outermost = getattr(_local, 'rpcs', None) is None
+            if outermost:
+                _local.rpcs = {}
+                _local.starts = {}
+                _local.sent = _local.received = _local.written = 0
+                _local.rpc_ms = 0.0
+                _local.spans = []
+            before = _snapshot()
+            start = time.time()
+            status = 'ok'
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                status = e.__class__.__name__
+                raise
+            finally:
+                rpcs, sent, received, written, rpc_ms = _delta(before)
+                span = {'name': span_name, 'status': status,
+                        'ms': round((time.time() - start) * 1000, 1),
+                        'rpc_ms': round(rpc_ms, 1), 'rpcs': rpcs,
+                        'bytes_sent': sent, 'bytes_received': received,
+                        'bytes_written': written}
+                if _over_budget(span_name, rpcs):
+                    span['over_budget'] = True
+                _local.spans.append(span)
+                if outermost:
+                    spans = _local.spans
+                    _local.rpcs = None
+                    _finish(spans)
+                if (STRICT_BUDGETS and status == 'ok' and
+                        span.get('over_budget')):
+                    raise BudgetExceeded('{} made {} datastore RPCs'.format(
+                        span_name, _datastore_rpcs(rpcs)))
+        return wrapper
+    return decorator
+
+
+def _bucket(ms):
+    for bound in BUCKETS:
+        if ms <= bound:
+            return str(bound)
+    return 'inf'
+
+
+def _finish(spans):
+    """Logs the spans of a request and adds them to the current minute's
+    histograms"""
+    offsets = {}
+    for span in spans:
+        name = span['name']
+        if span.get('over_budget'):
+            key = name + ':over_budget'
+            offsets[key] = offsets.get(key, 0) + 1
+        offsets[name + ':count'] = offsets.get(name + ':count', 0) + 1
+        key = '{}:ms:{}'.format(name, _bucket(span['ms']))
+        offsets[key] = offsets.get(key, 0) + 1
+        for kind, count in span['rpcs'].items():
+            key = '{}:rpc:{}'.format(name, kind)
+            offsets[key] = offsets.get(key, 0) + count
+        for field in ('bytes_sent', 'bytes_received', 'bytes_written'):
+            key = '{}:{}'.format(name, field)
+            offsets[key] = offsets.get(key, 0) + span[field]
+    logging.info('instrument %s', json.dumps(spans, sort_keys=True))
+    for listener in _LISTENERS:
+        listener(spans)
+    for span in spans:
+        if span.get('over_budget'):
+            logging.warning('%s is over its budget of %s datastore RPCs',
+                            span['name'],
+                            BUDGETS.get(span['name'], DEFAULT_BUDGET))
+    minute = int(time.time()) // 60
+    try:
+        memcache.offset_multi(offsets,
+                              key_prefix='instrument:{}:'.format(minute),
+                              initial_value=0)
+    except Exception:
+        # the numbers are best effort and must never fail a request
+        logging.exception('Could not publish instrumentation')
+
+
+def _percentile(histogram, count, fraction):
+    """Returns the upper bound of the bucket holding the given fraction of
+    the calls, or None if there were none"""
+    seen = 0
+    for bound in [str(b) for b in BUCKETS] + ['inf']:
+        seen += histogram[bound]
+        if count and seen >= fraction * count:
+            return bound
+    return None
+
+
+def stats(names=None, minutes=WINDOW):
+    """Returns the per-span statistics of the last `minutes` minutes from
+    every instance, as a dict keyed by span name"""
+    names = sorted(names or _NAMES)
+    now = int(time.time()) // 60
+    fields = (['count', 'over_budget', 'bytes_sent', 'bytes_received',
+               'bytes_written'] +
+              ['ms:' + str(b) for b in BUCKETS] + ['ms:inf'] +
+              ['rpc:' + kind for kind in KINDS])
+    keys = ['instrument:{}:{}:{}'.format(minute, name, field)
+            for minute in range(now - minutes + 1, now + 1)
+            for name in names for field in fields]
+    found = memcache.get_multi(keys)
+    totals = {}
+    for key, value in found.items():
+        _, _, name, field = key.split(':', 3)
+        span = totals.setdefault(name, {})
+        span[field] = span.get(field, 0) + int(value)
+
+    report = {}
+    for name in names:
+        span = totals.get(name, {})
+        count = span.get('count', 0)
+        if not count:
+            continue
+        histogram = dict((str(b), span.get('ms:' + str(b), 0))
+                         for b in BUCKETS)
+        histogram['inf'] = span.get('ms:inf', 0)
+        report[name] = {
+            'count': count,
+            'budget': BUDGETS.get(name, DEFAULT_BUDGET),
+            'over_budget': span.get('over_budget', 0),
+            'p50_ms': _percentile(histogram, count, 0.5),
+            'p99_ms': _percentile(histogram, count, 0.99),
+            'histogram_ms': histogram,
+            'rpcs_per_call': dict(
+                (kind, round(span['rpc:' + kind] / float(count), 2))
+                for kind in KINDS if span.get('rpc:' + kind)),
+            'bytes_sent_per_call': span.get('bytes_sent', 0) // count,
+            'bytes_received_per_call':
+                span.get('bytes_received', 0) // count,
+            'bytes_written_per_call': span.get('bytes_written', 0) // count,
+        }
+    return report
@@ -14,65 +14,376 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import datetime
+import json
 import logging
+import time
 
 import webapp2
-from google.appengine.api import mail, app_identity
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
-from api import ZombieDiceA
-from utils import get_by_urlsafe
+import cache
+import instrument
+from utils import get_by_urlsafe, get_multi_dict, fetch_page, parse_cursor
 
-from models import User, Game
+from models import User, Game, Score
+
+
+def send_mail(to, subject, body):
+    """Sends an email from the app's noreply address"""
+    # imported here: the mail API pulls in the email package, which only
+    # the email crons need, on every cold start of main.app
+    from google.appengine.api import app_identity, mail
+    mail.send_mail('noreply@{}.appspotmail.com'.
+                   format(app_identity.get_application_id()),
+                   to, subject, body)
+
+
+def add_once(tasks, queue_name='default'):
+    """Adds named tasks, skipping the ones that a retry of the request
+    already added"""
+    queue = taskqueue.Queue(queue_name)
+    for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+        try:
+            queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
 
 
 class SendReminderEmail(webapp2.RequestHandler):
 
+    PAGE_SIZE = 1000  # (game, player) pairs scanned per task
+    MAX_PAYLOAD = 64 * 1024  # bytes of one /tasks/send_reminders payload
+    MAX_LISTED = 50  # game keys listed in one reminder email
+
     def get(self):
-        """Send a reminder email to each User with an email who has
-        games in progress. Email body includes a count of active games and
-        their urlsafe keys
+        """Start queueing a reminder email to each User who has games in
+        progress. The games are scanned a page at a time by chained
+        /tasks/scan_reminders tasks.
         Called every twelve hours using a cron job"""
-        users = User.query(User.email is not None)
-
-        for user in users:
-            qry = Game.query(Game.players == user.key)
-            games = qry.filter(Game.game_over == False)
-            if games.count() > 0:
-                subject = 'This is a reminder!'
-                body = 'Hello {}, you have {} games in progress. Their' \
-                       ' keys are: {}'.\
-                    format(user.name,
-                           games.count(),
-                           ', '.join(game.key.urlsafe() for game in games))
-                logging.debug(body)
-                # This will send test emails, the arguments to send_mail are:
-                # from, to, subject, body
-                mail.send_mail('noreply@{}.appspotmail.com'.
-                               format(app_identity.get_application_id()),
-                               user.email,
-                               subject,
-                               body)
+        run = datetime.datetime.utcnow().strftime('%Y%m%d%H%M')
+        add_once([taskqueue.Task(url='/tasks/scan_reminders',
+                                 params={'run': run, 'page': 0},
+                                 name='scan-reminders-{}-0'.format(run))])
+
+    def post(self):
+        """Scan one page of the games in progress with an index-only query,
+        group them by player and queue their reminders on the 'reminders'
+        queue in payloads of at most MAX_PAYLOAD bytes, then queue the next
+        page. Results are ordered by player, and a page only ends between
+        two players, so every player gets a single email"""
+        run = self.request.get('run')
+        page = int(self.request.get('page'))
+        # a projection on the repeated players property returns one result
+        # per (game, player) pair
+        query = Game.query(Game.game_over == False).order(Game.players)
+        results = query.iter(projection=[Game.players], produce_cursors=True,
+                             start_cursor=parse_cursor(
+                                 self.request.get('cursor')))
+        games = {}
+        players = []
+        cursor = None
+        for count, game in enumerate(results):
+            player = game.players[0].urlsafe()
+            if count >= self.PAGE_SIZE and player != players[-1]:
+                cursor = results.cursor_before()
+                break
+            if player not in games:
+                players.append(player)
+                games[player] = {'count': 0, 'games': []}
+            games[player]['count'] += 1
+            if len(games[player]['games']) < self.MAX_LISTED:
+                games[player]['games'].append(game.key.urlsafe())
+
+        batches = []
+        size = self.MAX_PAYLOAD
+        for player in players:
+            item = len(json.dumps({player: games[player]}))
+            if size + item > self.MAX_PAYLOAD:
+                batches.append({})
+                size = 0
+            batches[-1][player] = games[player]
+            size += item
+        tasks = []
+        for i, batch in enumerate(batches):
+            tasks.append(taskqueue.Task(
+                url='/tasks/send_reminders', payload=json.dumps(batch),
+                name='reminders-{}-{}-{}'.format(run, page, i)))
+        add_once(tasks, 'reminders')
+        logging.info('Queued reminders for %d players in %d tasks',
+                     len(players), len(batches))
+        if cursor:
+            add_once([taskqueue.Task(
+                url='/tasks/scan_reminders',
+                params={'run': run, 'page': page + 1,
+                        'cursor': cursor.urlsafe()},
+                name='scan-reminders-{}-{}'.format(run, page + 1))])
+
+
+class SendReminders(webapp2.RequestHandler):
+
+    def post(self):
+        """Send the reminder emails for one batch of players. The payload
+        maps urlsafe User keys to the number of their games in progress and
+        the urlsafe keys of up to MAX_LISTED of them. Email body includes
+        the count of active games and their urlsafe keys"""
+        games = json.loads(self.request.body)
+        keys = [ndb.Key(urlsafe=player) for player in games]
+        for user in ndb.get_multi(keys):
+            if not user or not user.email:
+                continue
+            entry = games[user.key.urlsafe()]
+            subject = 'This is a reminder!'
+            body = u'Hello {}, you have {} games in progress. Their' \
+                   ' keys are: {}'.\
+                format(user.name,
+                       entry['count'],
+                       ', '.join(entry['games']))
+            if entry['count'] > len(entry['games']):
+                body += ' and {} more'.format(
+                    entry['count'] - len(entry['games']))
+            logging.debug(body)
+            send_mail(user.email, subject, body)
 
 
 class SendMoveEmail(webapp2.RequestHandler):
 
+    BATCH_SIZE = 50  # most players emailed per run
+    LEASE_SECONDS = 60
+
+    def get(self):
+        """Send each User one email listing the games where it's their turn.
+        Game.end_turn queues a pull task tagged with the next player's key
+        for every turn, and all the tasks queued for a player since the
+        last run are coalesced into a single email. Each run makes one
+        pass over at most BATCH_SIZE players and leaves the rest, along
+        with any turns that come in meanwhile, to the next run, so turns
+        keep coalescing between runs instead of being mailed as they come.
+        Called every minute using a cron job"""
+        queue = taskqueue.Queue('notifications')
+        leased = []
+        games = {}
+        for _ in range(self.BATCH_SIZE):
+            # leases the tasks sharing the tag of the oldest task
+            tasks = queue.lease_tasks_by_tag(self.LEASE_SECONDS, 1000)
+            if not tasks:
+                break
+            leased.extend(tasks)
+            for task in tasks:
+                games.setdefault(task.tag, set()).add(task.payload)
+        if not leased:
+            return
+        self.send_digests(games)
+        for i in range(0, len(leased), 1000):
+            queue.delete_tasks(leased[i:i + 1000])
+
+    def send_digests(self, games):
+        """Send the emails for a dict mapping urlsafe User keys to the
+        urlsafe keys of the games they were notified about, skipping games
+        that are over or have moved on to another player since"""
+        user_keys = [ndb.Key(urlsafe=user) for user in games]
+        game_keys = set(ndb.Key(urlsafe=game)
+                        for user_games in games.values()
+                        for game in user_games)
+        found = get_multi_dict(user_keys + list(game_keys))
+        # only games without a seed need their turn read to find the player
+        turns = get_multi_dict([game.next_turn for game in found.values()
+                                if isinstance(game, Game) and
+                                not game.game_over and
+                                game.current_player() is None])
+        for user_key in user_keys:
+            user = found[user_key]
+            if not user or not user.email:
+                continue
+            waiting = []
+            for urlsafe in sorted(games[user_key.urlsafe()]):
+                game = found[ndb.Key(urlsafe=urlsafe)]
+                if not game or game.game_over:
+                    continue
+                player = game.current_player()
+                if player is None:
+                    turn = turns.get(game.next_turn)
+                    player = turn and turn.player
+                if player == user_key:
+                    waiting.append(urlsafe)
+            if not waiting:
+                continue
+            subject = 'It\'s your turn!'
+            body = u'{}, It\'s your turn to play Zombie Dice in {} games. ' \
+                   'The game keys are: {}'.\
+                format(user.name, len(waiting), ', '.join(waiting))
+            logging.debug(body)
+            send_mail(user.email, subject, body)
+
+
+class SweepGames(webapp2.RequestHandler):
+
+    BATCH_SIZE = 100
+    DEFAULT_TTL_DAYS = 30
+    TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+    def get(self):
+        """Start sweeping the games nobody has touched for ttl_days (a
+        query parameter, defaulting to DEFAULT_TTL_DAYS): abandoned games
+        are deleted and finished ones are compacted to their final scores.
+        Called every day using a cron job"""
+        ttl_days = int(self.request.get('ttl_days', self.DEFAULT_TTL_DAYS))
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+            days=ttl_days)
+        taskqueue.add(url='/tasks/sweep_games',
+                      params={'cutoff': cutoff.strftime(self.TIME_FORMAT)})
+
+    def post(self):
+        """Sweep one batch of games, then queue the next batch"""
+        cutoff = self.request.get('cutoff')
+        cursor = Game.sweep(
+            datetime.datetime.strptime(cutoff, self.TIME_FORMAT),
+            self.BATCH_SIZE, self.request.get('cursor'))
+        if cursor:
+            taskqueue.add(url='/tasks/sweep_games',
+                          params={'cutoff': cutoff, 'cursor': cursor})
+
+
+class BackfillRankings(webapp2.RequestHandler):
+
+    BATCH_SIZE = 100
+
+    def get(self):
+        """Start rewriting every User so that the stored win_percentage
+        and ranked properties used by the rankings are indexed and every
+        ranked User is counted in its rank bucket.
+        Run once by an admin after deploying, or after MIN_RANKED_GAMES
+        changes"""
+        taskqueue.add(url='/tasks/backfill_rankings')
+        self.response.write('Backfill started')
+
+    def post(self):
+        """Rewrite one batch of Users, then queue the next batch"""
+        keys, cursor = fetch_page(User.query(), self.BATCH_SIZE,
+                                  self.request.get('cursor'),
+                                  keys_only=True)
+        for key in keys:
+            User.reindex(key)
+        if cursor:
+            taskqueue.add(url='/tasks/backfill_rankings',
+                          params={'cursor': cursor})
+
+
+class MigrateUserKeys(webapp2.RequestHandler):
+
+    BATCH_SIZE = 20
+
+    def get(self):
+        """Start moving every User created before Users were keyed by
+        their normalized name onto its name key.
+        Run once by an admin after deploying"""
+        taskqueue.add(url='/tasks/migrate_user_keys')
+        self.response.write('Migration started')
+
+    def post(self):
+        """Move one batch of Users, then queue the next batch"""
+        from models.migration import is_legacy_user, migrate_user_key
+        keys, cursor = fetch_page(User.query(), self.BATCH_SIZE,
+                                  self.request.get('cursor'),
+                                  keys_only=True)
+        for key in keys:
+            if is_legacy_user(key):
+                migrate_user_key(key)
+        if cursor:
+            taskqueue.add(url='/tasks/migrate_user_keys',
+                          params={'cursor': cursor})
+
+
+class MigrateGameScores(webapp2.RequestHandler):
+
+    BATCH_SIZE = 50
+
+    def get(self):
+        """Start moving the pickled statuses of every Game to its scores
+        and player_names. Run once by an admin after deploying, after
+        /tasks/migrate_user_keys has finished"""
+        taskqueue.add(url='/tasks/migrate_game_scores')
+        self.response.write('Migration started')
+
+    def post(self):
+        """Migrate one batch of Games, then queue the next batch"""
+        from models.migration import migrate_game_scores
+        games, cursor = fetch_page(Game.query(), self.BATCH_SIZE,
+                                   self.request.get('cursor'))
+        migrated = migrate_game_scores(games)
+        logging.info('Migrated the scores of %d games', migrated)
+        if cursor:
+            taskqueue.add(url='/tasks/migrate_game_scores',
+                          params={'cursor': cursor})
+
+
+class TallyScore(webapp2.RequestHandler):
+
     def post(self):
-        """Send an email to a User that it is their turn"""
-        logging.debug('HEREERERER"')
-        user = get_by_urlsafe(self.request.get('user_key'), User)
-        game = get_by_urlsafe(self.request.get('game_key'), Game)
-        subject = 'It\'s your turn!'
-        body = '{}, It\'s your turn to play Zombie Dice. The game key is: {}'.\
-            format(user.name, game.key.urlsafe())
-        logging.debug(body)
-        mail.send_mail('noreply@{}.appspotmail.com'.
-                       format(app_identity.get_application_id()),
-                       user.email,
-                       subject,
-                       body)
+        """Add a finished game to its players' sharded win/played
+        counters. Queued by Game.end_game in the game's transaction"""
+        score = get_by_urlsafe(self.request.get('score_key'), Score)
+        score.tally()
+
+
+class SyncUser(webapp2.RequestHandler):
+
+    def post(self):
+        """Copy a User's counter totals onto the User for the rankings"""
+        User.sync(ndb.Key(urlsafe=self.request.get('user_key')))
+
+
+class InstrumentStats(webapp2.RequestHandler):
+
+    def get(self):
+        """Show the RPC counts, bytes and latency histograms of every
+        instrumented endpoint and model method as JSON, over the last
+        `minutes` minutes (a query parameter)"""
+        import api  # registers the names of the endpoint spans
+        minutes = int(self.request.get('minutes', instrument.WINDOW))
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(instrument.stats(minutes=minutes),
+                                       indent=2, sort_keys=True))
+
+
+class CacheStats(webapp2.RequestHandler):
+
+    def get(self):
+        """Show the read cache hits, misses and sizes of the instance that
+        serves the request as JSON"""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(cache.stats(), indent=2,
+                                       sort_keys=True))
+
+
+class Warmup(webapp2.RequestHandler):
+
+    def get(self):
+        """Import the endpoints app and warm it up before App Engine sends
+        a new instance traffic"""
+        start = time.time()
+        import api
+        imported = time.time()
+        api.warm_up()
+        logging.info('Warmup: imports %.0f ms, warm_up %.0f ms',
+                     (imported - start) * 1000,
+                     (time.time() - imported) * 1000)
 
 
 app = webapp2.WSGIApplication([
     ('/crons/send_reminder', SendReminderEmail),
-    ('/tasks/send_move_email', SendMoveEmail),
+    ('/crons/send_move_email', SendMoveEmail),
+    ('/tasks/scan_reminders', SendReminderEmail),
+    ('/tasks/send_reminders', SendReminders),
+    ('/crons/sweep_games', SweepGames),
+    ('/tasks/sweep_games', SweepGames),
+    ('/tasks/backfill_rankings', BackfillRankings),
+    ('/tasks/migrate_user_keys', MigrateUserKeys),
+    ('/tasks/migrate_game_scores', MigrateGameScores),
+    ('/tasks/tally_score', TallyScore),
+    ('/tasks/sync_user', SyncUser),
+    ('/admin/stats', InstrumentStats),
+    ('/admin/cache_stats', CacheStats),
+    ('/_ah/warmup', Warmup),
 ], debug=True)
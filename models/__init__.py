@@ -1,4 +1,8 @@
 from .user import User, UserForm, UserForms
 from .game import Game, GameForm, GameForms, NewGameForm, StringMessage
 from .score import Score, ScoreForm, ScoreForms
-from .turn import Turn, TurnForm, TurnForms, TakeTurnForm
\ No newline at end of file
+from .turn import Turn, TurnForm, TurnForms, TakeTurnForm
+from .turn import TurnActionForm, TurnActionForms
+from .advice import AdviceTable, AdviceForm
+from .counter import CounterShard
+from .stats import StatsForm, DayStatsForm
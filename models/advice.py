@@ -0,0 +1,36 @@
+"""advice.py - roll/stop advice class definitions for the Zombie Dice game."""
+
+from protorpc import messages
+from google.appengine.ext import ndb
+
+import advisor
+
+
+class AdviceTable(ndb.Model):
+    """Solved advisor table, stored so new instances don't have to solve it.
+    Keyed by advisor.VERSION"""
+    data = ndb.BlobProperty(compressed=True)
+
+    @classmethod
+    def load(cls):
+        """Makes sure the advisor has a table, reading it from the datastore
+        or solving and storing it on first use"""
+        if advisor.get_table() is not None:
+            return
+        key = ndb.Key(cls, advisor.VERSION)
+        stored = key.get()
+        if stored:
+            advisor.set_table(advisor.loads(stored.data))
+        else:
+            table = advisor.solve()
+            cls(key=key, data=advisor.dumps(table)).put()
+            advisor.set_table(table)
+
+
+class AdviceForm(messages.Message):
+    """Used to report whether a turn should keep rolling"""
+    turn_key = messages.StringField(1, required=True)
+    bust_probability = messages.FloatField(2, required=True)
+    stop_brains = messages.IntegerField(3, required=True)
+    roll_brains = messages.FloatField(4, required=True)
+    roll = messages.BooleanField(5, required=True)
@@ -0,0 +1,68 @@
+"""counter.py - sharded counters for the Zombie Dice game.
+
+A counter is spread over NUM_SHARDS root entities so that concurrent
+increments land on different entity groups. Totals are cached in memcache.
+"""
+
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+NUM_SHARDS = 20
+# seconds a cached total is trusted before the shards are summed again.
+# increment moves cached totals on commit, so this only bounds how long a
+# total stays off after an update to memcache is lost
+CACHE_TIME = 60 * 60
+
+
+class CounterShard(ndb.Model):
+    """One shard of a named counter, keyed by '<name>:<shard index>'"""
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+
+def _cache_key(name):
+    return 'counter:' + name
+
+
+def _shard_keys(name):
+    return [ndb.Key(CounterShard, '{}:{}'.format(name, i))
+            for i in range(NUM_SHARDS)]
+
+
+@ndb.transactional
+def increment(name, delta=1):
+    """Adds delta to a random shard of the named counter. Joins the
+    caller's transaction if there is one"""
+    key = random.choice(_shard_keys(name))
+    shard = key.get() or CounterShard(key=key)
+    shard.count += delta
+    shard.put()
+    # only moves a total that is already cached; unlike incr, offset_multi
+    # takes negative deltas
+    ndb.get_context().call_on_commit(
+        lambda: memcache.offset_multi({_cache_key(name): delta}))
+
+
+def get_counts(names, cached=True):
+    """Returns a dict of the totals of several counters. Totals missing
+    from memcache, or all of them when cached is False, are summed from
+    the shards with a single get_multi"""
+    totals = {}
+    if cached:
+        found = memcache.get_multi([_cache_key(name) for name in names])
+        for name in names:
+            if _cache_key(name) in found:
+                totals[name] = found[_cache_key(name)]
+    missing = [name for name in names if name not in totals]
+    if not missing:
+        return totals
+    shards = ndb.get_multi([key for name in missing
+                            for key in _shard_keys(name)])
+    for i, name in enumerate(missing):
+        totals[name] = sum(shard.count for shard in
+                           shards[i * NUM_SHARDS:(i + 1) * NUM_SHARDS]
+                           if shard)
+    memcache.set_multi(dict((_cache_key(name), totals[name])
+                            for name in missing), time=CACHE_TIME)
+    return totals
@@ -1,140 +1,354 @@
 """game.py - game-related class definitions for the Zombie Dice game."""
 
+import random
 from datetime import date
 from protorpc import messages
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
+
+import cache
+import engine
+import instrument
+from utils import fetch_page
+from .score import Score
+from .storage import get_storage
 from .turn import Turn # game logic needs to be able to create turns
 
-class Game(ndb.Model):
+# new games keep their active turn on the Game instead of in a Turn entity,
+# so that rolling and handing the dice on each write a single entity
+EMBED_ACTIVE_TURN = True
+# seconds the version of a game stays in memcache after its last change
+VERSION_CACHE_TIME = 24 * 60 * 60
+# attempts at moving a cached version forward before dropping it
+VERSION_CAS_RETRIES = 5
+
+
+def _version_cache_key(key):
+    return 'game-version:' + key.urlsafe()
+
+
+def _publish_version(key, version):
+    """Caches a game's version in memcache unless a newer one is already
+    there. Commits can publish out of order, and an older version must
+    never replace a newer one or pollers would miss the change"""
+    client = memcache.Client()
+    name = _version_cache_key(key)
+    for _ in range(VERSION_CAS_RETRIES):
+        cached = client.gets(name)
+        if cached is None:
+            if client.add(name, version, time=VERSION_CACHE_TIME):
+                return
+        elif cached >= version:
+            return
+        elif client.cas(name, version, time=VERSION_CACHE_TIME):
+            return
+    # readers fall back to the datastore
+    client.delete(name)
+
+
+class Game(cache.CachedModel):
     """Game object"""
     players = ndb.KeyProperty(repeated=True, kind='User')
+    # the brains and names of the players, in the same order as players
+    scores = ndb.IntegerProperty(repeated=True)
+    player_names = ndb.StringProperty(repeated=True, indexed=False)
+    # pickled {player key: brains} of games from before scores, read only
     statuses = ndb.PickleProperty()
     next_turn = ndb.KeyProperty()  # whose turn it is
     final_player = ndb.KeyProperty()
     game_over = ndb.BooleanProperty(required=True, default=False)
     winner = ndb.KeyProperty()
+    updated = ndb.DateTimeProperty(auto_now=True)
+    # True once a finished game's turns have been deleted by the sweeper
+    compacted = ndb.BooleanProperty(default=False)
+    # every roll of the game follows from its seed, so the finished turns
+    # are kept as a log of how many rolls each one took
+    seed = ndb.IntegerProperty(indexed=False)
+    log = ndb.BlobProperty()
+    turn_count = ndb.IntegerProperty(default=0)  # finished turns
+    # rolls taken in the active turn, which the game embeds; None when the
+    # active turn is a Turn entity
+    turn_rolls = ndb.IntegerProperty(indexed=False)
+    # bumped by every put, so clients can tell whether the game changed
+    version = ndb.IntegerProperty(default=0, indexed=False)
+
+    def _pre_put_hook(self):
+        super(Game, self)._pre_put_hook()
+        self.version += 1
+        if ndb.in_transaction():
+            # only publish the version once the write has landed
+            ndb.get_context().call_on_commit(self._cache_version)
+
+    def _post_put_hook(self, future):
+        super(Game, self)._post_put_hook(future)
+        if not ndb.in_transaction() and not future.get_exception():
+            self._cache_version()
+
+    def _cache_version(self):
+        _publish_version(self.key, self.version)
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        super(Game, cls)._post_delete_hook(key, future)
+        memcache.delete(_version_cache_key(key))
 
     @classmethod
-    def new_game(cls, *args):
-        """creates and returns a new game"""
-
-        # creates the game
-        game = Game()  
-        game.statuses = {}
-        # strip out the list to get to the underlying keys
-        for item in args:
-            for player in item:
-                game.players.append(player)
-                # sets the next_turn to the first player in the list of players
-                game.statuses[player] = 0
-
-        game.put()
+    def current_version(cls, key):
+        """Returns the version of a game from memcache, falling back to a
+        single get of the Game. None if the game does not exist"""
+        version = memcache.get(_version_cache_key(key))
+        if version is not None:
+            return version
+        game = key.get()
+        if not isinstance(game, Game):
+            return None
+        game._cache_version()
+        return game.version
+
+    @classmethod
+    def new_game(cls, players, names):
+        """creates and returns a new game between the players, whose names
+        are given in the same order"""
+
+        # creates the game; the first player in the list goes first
+        game = Game(seed=random.getrandbits(63),
+                    players=list(players),
+                    scores=[0] * len(players),
+                    player_names=list(names))
+
+        storage = get_storage()
+        if EMBED_ACTIVE_TURN:
+            # the first turn's key follows from the game's, so allocate an
+            # id and write the game once
+            game.key = ndb.Key(Game, storage.allocate_id(Game))
+            game.turn_rolls = 0
+            game.next_turn = Turn.key_for(game.key, 0)
+            storage.put_multi([game])
+            return game
+        storage.put_multi([game])
         # finish creating the game (to get a key) before creating next turn
-        next_turn = Turn.new_turn(game.players[0], game.key)
+        next_turn = Turn.new_turn(game.players[0], game.key, 0, game.seed)
         game.next_turn = next_turn.key
-        game.put()
+        storage.put_multi([game, next_turn])
         return game
 
-    def to_form(self):
-        """Returns a GameForm representation of the Game"""
-        # get names of each player in the list of players
-        p = []
-        for player in self.players:
-            p.append(player.get().name)
-        # unpack the statuses dict and get names and scores for each player
-        s = []
-        for player, score in self.statuses.items():
-            name = player.get().name
-            s.append((name, score))
-
-        try:
-            finalPlayer = self.final_player.get().name
-        except AttributeError:
-            finalPlayer = "None"
+    def delete(self):
+        """Deletes the game and all of its turns"""
+        turn_keys = Turn.query(ancestor=self.key).fetch(keys_only=True)
+        ndb.delete_multi(turn_keys + [self.key])
+
+    @classmethod
+    def sweep(cls, cutoff, size, cursor=None):
+        """Sweeps one batch of the games not updated since cutoff. Games
+        still in progress are deleted along with their turns; finished
+        games keep their scores and winner but lose their turns.
+        Returns:
+            The urlsafe cursor of the next batch, or None when done."""
+        query = cls.query(cls.compacted == False, cls.updated < cutoff)
+        games, cursor = fetch_page(query, size, cursor)
+        # find the turns of every game in the batch in parallel
+        turn_keys = [Turn.query(ancestor=game.key).fetch_async(
+            keys_only=True) for game in games]
+        doomed = []
+        compacted = []
+        for game, turns in zip(games, turn_keys):
+            doomed.extend(turns.get_result())
+            if game.game_over:
+                game.compacted = True
+                compacted.append(game)
+            else:
+                doomed.append(game.key)
+        futures = ndb.delete_multi_async(doomed) + \
+            ndb.put_multi_async(compacted)
+        # get_result raises the first failure, so the batch is retried
+        # instead of the cursor moving past it
+        for future in futures:
+            future.get_result()
+        return cursor
+
+    def history(self, offset, size):
+        """Replays a page of the game's turns from its log, ending with the
+        turn in progress. Only seeded games have a log.
+        Returns:
+            A (turns, next_offset) tuple. next_offset is None on the last
+            page."""
+        turns = []
+        stop = offset + size
+        for number, rolls in enumerate(engine.read_log(self.log)):
+            if number >= stop:
+                break
+            if number >= offset:
+                turns.append(Turn.replay(self, number, rolls))
+        total = self.turn_count
+        if not self.game_over:
+            total += 1
+            if offset <= self.turn_count < stop and self.turn_rolls is None:
+                turns.append(self.next_turn.get())
+            elif offset <= self.turn_count < stop:
+                turns.append(Turn.embedded(self))
+        if stop < total:
+            return turns, stop
+        return turns, None
+
+    @classmethod
+    @instrument.instrumented('Game.to_forms')
+    def to_forms(cls, games):
+        """Returns GameForms for a list of Games. Player names are stored on
+        the games, so only the players of games from before that and the
+        next turns of unfinished games without a seed are fetched, with a
+        single get_multi"""
+        keys = set()
+        for game in games:
+            if len(game.player_names) != len(game.players):
+                keys.update(game.players)
+            if game.seed is None and not game.game_over:
+                keys.add(game.next_turn)
+        keys = list(keys)
+        entities = dict(zip(keys, get_storage().get_multi(keys)))
+        return [game.to_form(entities) for game in games]
+
+    def to_form(self, entities=None):
+        """Returns a GameForm representation of the Game. entities maps keys
+        to already fetched Users and Turns"""
+        if entities is None:
+            return Game.to_forms([self])[0]
+        names = self.player_names
+        if len(names) != len(self.players):
+            names = [entities[player].name for player in self.players]
+        named = dict(zip(self.players, names))
+
+        finalPlayer = "None"
+        if self.final_player:
+            finalPlayer = named[self.final_player]
 
         form = GameForm(urlsafe_key=self.key.urlsafe(),
-                        status=str(s),
-                        players=str(p),
-                        next_turn=self.next_turn.get().player.get().name,
+                        status=str(list(zip(names, self.current_scores()))),
+                        players=str(list(names)),
                         final_player=finalPlayer,
                         game_over=self.game_over,
-                        next_turn_key=str(self.next_turn.urlsafe()))
+                        next_turn_key=str(self.next_turn.urlsafe()),
+                        version=self.version)
         if self.winner:
-            form.winner = self.winner.get().name
+            form.winner = named[self.winner]
+        if not self.game_over:
+            next_player = self.current_player()
+            if next_player is None:
+                turn = entities.get(self.next_turn)
+                next_player = turn and turn.player
+            if next_player:
+                form.next_turn = named[next_player]
         return form
 
+    def current_player(self):
+        """Returns the key of the player whose turn it is. None for games
+        without a seed, whose next turn has to be read to tell"""
+        if self.seed is None:
+            return None
+        # seeded games number their turns, and seats take turns in order
+        return self.players[self.turn_count % len(self.players)]
+
+    def current_scores(self):
+        """Returns the score of each player, in the order of players. Games
+        from before scores were stored keep them in the pickled statuses
+        until MigrateGameScores has run"""
+        if self.scores or not self.statuses:
+            return self.scores
+        return [self.statuses[player] for player in self.players]
+
     def end_game(self, winner):
-        """Ends the game"""
+        """Ends the game. Returns the new Score for the caller to put. Must
+        run in the caller's transaction: the players' counters are updated
+        by a task that is only queued if the Score is written"""
         self.winner = winner
         self.game_over = True
-        self.put()
         losers = []
         for player in self.players:
             if player != self.winner:
                 losers.append(player)
-        score = Score(date=date.today(), winner=winner, losers=losers)
-        score.put()
+        # end_turn only counts the turn that ended the game afterwards
+        score = Score(key=ndb.Key(Score, self.key.id()),
+                      date=date.today(), winner=winner, losers=losers,
+                      turns=self.turn_count + 1)
 
         # update the users
-        winner.get().add_win()
-        for loser in losers:
-            loser.get().add_loss()
+        get_storage().add_task('/tasks/tally_score',
+                               {'score_key': score.key.urlsafe()})
+        return [score]
 
+    @instrument.instrumented('Game.end_turn')
     def end_turn(self, turn):
         """Adds brains to the player's score,
-        creates a new turn and updates the next_turn, checks win conditions"""
+        creates a new turn and updates the next_turn, checks win conditions.
+        Nothing is written here: returns every entity that changed, the game
+        included, for the caller to put"""
         # get the index of the last player
         i = self.players.index(turn.player)
-        # only score if player didn't die from 3 or more shots
-        if turn.shots < 3:
-            score = self.statuses[turn.player]
-            score += turn.brains
-            self.statuses[turn.player] = score
-            self.put()
-
-            # if the last player to play was the final player, figure out the
-            # winner and end the game
-            if turn.player == self.final_player:
-                winner = max(
-                    self.statuses.iterkeys(), key=(
-                        lambda key: self.statuses[key]))
-                self.end_game(winner)
-            if score > 12:
-                # this works because the first player has an index of 0
-                # and getting list[-1] returns the last item on the list
-                self.final_player = self.players[i - 1]
+        scores = list(self.current_scores())
+        final = None
+        if self.final_player:
+            final = self.players.index(self.final_player)
+        final, winner = engine.score_turn(
+            scores, i, turn.brains, turn.shots, final)
+        self.scores = scores
+        self.statuses = None
+        if final is not None:
+            self.final_player = self.players[final]
+        changed = [self]
+        if winner is not None:
+            changed.extend(self.end_game(self.players[winner]))
+
+        if self.seed is not None:
+            self.log = engine.append_log(self.log, turn.rolls)
+        self.turn_count += 1
 
         # if at the end of the players list, start back at the beginning
         if len(self.players) - 1 == i:
-            next_turn = Turn.new_turn(self.players[0], self.key)
+            next_player = self.players[0]
 
         # otherwise just go to the next player on the list
         else:
-            next_turn = Turn.new_turn(self.players[i + 1], self.key)
+            next_player = self.players[i + 1]
+        next_turn = Turn.new_turn(next_player, self.key, self.turn_count,
+                                  self.seed)
 
-        # save our work
-        self.next_turn = next_turn.key
-        next_turn.put()
         # update the game's next turn to be the new turn generated
         self.next_turn = next_turn.key
-        self.put()
-        
+        if self.turn_rolls is None:
+            changed.append(next_turn)
+        else:
+            # the new turn lives on the game until it ends
+            self.turn_rolls = 0
+        if not self.game_over:
+            self.notify(next_turn.player)
+        return changed
+
+    def notify(self, player):
+        """Queues a your-turn notification for the player, tagged with the
+        player so that the cron can send one email for all of them. Only
+        queued if the caller's transaction commits"""
+        get_storage().add_pull_task('notifications', self.key.urlsafe(),
+                                    player.urlsafe())
+
 
 class GameForm(messages.Message):
-    """GameForm for outbound game state information"""
+    """GameForm for outbound game state information. A not_modified form
+    only sets urlsafe_key and version"""
     urlsafe_key = messages.StringField(1, required=True)
-    status = messages.StringField(2, required=True)
-    next_turn = messages.StringField(3, required=True)
+    status = messages.StringField(2)
+    next_turn = messages.StringField(3)
     final_player = messages.StringField(4, default="None")
-    game_over = messages.BooleanField(5, required=True)
+    game_over = messages.BooleanField(5)
     winner = messages.StringField(7)
     players = messages.StringField(8)
-    next_turn_key = messages.StringField(9, required=True)
+    next_turn_key = messages.StringField(9)
+    version = messages.IntegerField(10)
+    not_modified = messages.BooleanField(11, default=False)
 
 
 class GameForms(messages.Message):
     """Container for multiple Game Forms"""
     items = messages.MessageField(GameForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class NewGameForm(messages.Message):
@@ -0,0 +1,114 @@
+"""migration.py - one-off data migrations for the Zombie Dice game."""
+
+import logging
+
+from google.appengine.ext import ndb
+
+from utils import get_multi_dict
+from .game import Game
+from .score import Score
+from .turn import Turn
+from .user import User
+
+
+def is_legacy_user(key):
+    """True for Users created before Users were keyed by name"""
+    return isinstance(key.id(), (int, long))
+
+
+def migrate_user_key(old):
+    """Moves a User with an allocated id to the key of its name and points
+    every Game, Turn, Score and counter of the user at the new key. Safe to
+    run again after a failure part way through.
+    Returns:
+        The new key, or None if another User already has the name."""
+    user = old.get()
+    if user is None:
+        return None
+    new = User.key_for(user.name)
+    if not _copy_user(user, new):
+        logging.error('Cannot move User %s to %s: the name is taken',
+                      old.id(), new.id())
+        return None
+    for key in Game.query(Game.players == old).iter(keys_only=True):
+        _rekey_game(key, old, new)
+    for query in (Score.query(Score.winner == old),
+                  Score.query(Score.losers == old)):
+        for key in query.iter(keys_only=True):
+            _rekey_score(key, old, new)
+    User.move_counters(old, new)
+    old.delete()
+    return new
+
+
+def _swap(key, old, new):
+    if key == old:
+        return new
+    return key
+
+
+@ndb.transactional
+def _copy_user(user, new):
+    existing = new.get()
+    if existing:
+        # copied by an earlier run, unless it is a different user whose
+        # name only differs in case
+        return existing.name == user.name
+    User(key=new, name=user.name, email=user.email, wins=user.wins,
+         total_played=user.total_played, sharded=user.sharded,
+         rank_bucket=user.rank_bucket).put()
+    return True
+
+
+@ndb.transactional
+def _rekey_game(key, old, new):
+    """Rewrites a game and its turns, which share its entity group"""
+    game = key.get()
+    game.players = [_swap(player, old, new) for player in game.players]
+    if game.statuses:
+        game.statuses = dict((_swap(player, old, new), score)
+                             for player, score in game.statuses.items())
+    game.final_player = _swap(game.final_player, old, new)
+    game.winner = _swap(game.winner, old, new)
+    turns = [turn for turn in Turn.query(ancestor=key)
+             if turn.player == old]
+    for turn in turns:
+        turn.player = new
+    ndb.put_multi([game] + turns)
+
+
+@ndb.transactional
+def _rekey_score(key, old, new):
+    score = key.get()
+    score.winner = _swap(score.winner, old, new)
+    score.losers = [_swap(player, old, new) for player in score.losers]
+    score.tallied = [_swap(player, old, new) for player in score.tallied]
+    score.put()
+
+
+def migrate_game_scores(games):
+    """Moves the pickled statuses of a batch of Games to scores and stores
+    their player names. Each game is rewritten in its own transaction, all
+    of them in parallel.
+    Returns:
+        The number of games that needed it."""
+    legacy = [game for game in games if game.statuses is not None or
+              len(game.player_names) != len(game.players)]
+    users = get_multi_dict([player for game in legacy
+                            for player in game.players])
+    futures = [_migrate_scores_async(game.key, users) for game in legacy]
+    # get_result raises the first failure, so the batch is retried
+    for future in futures:
+        future.get_result()
+    return len(legacy)
+
+
+@ndb.transactional_tasklet
+def _migrate_scores_async(key, users):
+    game = yield key.get_async()
+    game.scores = game.current_scores()
+    # run MigrateUserKeys first, or moved players lose their names here
+    game.player_names = [users[player].name if users.get(player) else ''
+                         for player in game.players]
+    game.statuses = None
+    yield game.put_async()
@@ -3,23 +3,63 @@
 from protorpc import messages
 from google.appengine.ext import ndb
 
-class Score(ndb.Model):
-    """Score object"""
+import cache
+from . import stats
+from .user import User
+
+class Score(cache.CachedModel):
+    """Score object, keyed by the id of its Game"""
     date = ndb.DateProperty(required=True)
     winner = ndb.KeyProperty(required=True)
     losers = ndb.KeyProperty(repeated=True)
+    tallied = ndb.KeyProperty(repeated=True)  # players already counted
+    turns = ndb.IntegerProperty(indexed=False)  # length of the game
+    rolled_up = ndb.BooleanProperty(default=False, indexed=False)
+
+    def tally(self):
+        """Adds the game to each player's win/played counters and to the
+        rolled up stats. Safe to run more than once: each player and the
+        stats are only counted the first time"""
+        players = [self.winner] + self.losers
+        for player in players:
+            self._tally_player(player)
+        self._roll_up(cache.get_names(players))
+        for player in players:
+            User.queue_sync(player)
+
+    @ndb.transactional(xg=True)
+    def _tally_player(self, player):
+        score = self.key.get()
+        if player in score.tallied:
+            return
+        if player == score.winner:
+            User.add_win(player)
+        else:
+            User.add_loss(player)
+        score.tallied.append(player)
+        score.put()
+
+    @ndb.transactional(xg=True)
+    def _roll_up(self, names):
+        score = self.key.get()
+        if score.rolled_up:
+            return
+        stats.roll_up(score, names)
+        score.rolled_up = True
+        score.put()
 
     def to_form(self):
+        names = cache.get_names([self.winner] + self.losers)
         return ScoreForm(date=str(self.date),
-                         winner=self.winner.get().name,
-                         losers=self.losers.get().name)
+                         winner=names[self.winner],
+                         losers=[names[loser] for loser in self.losers])
 
 
 class ScoreForm(messages.Message):
     """ScoreForm for outbound Score information"""
     date = messages.StringField(1, required=True)
     winner = messages.StringField(2, required=True)
-    losers = messages.StringField(3, required=True)
+    losers = messages.StringField(3, repeated=True)
 
 
 class ScoreForms(messages.Message):
@@ -0,0 +1,100 @@
+"""stats.py - rolled up game statistics for the Zombie Dice game.
+
+Every finished game adds to sharded counters (see counter.py) once, when its
+Score is tallied: games and turns played per day, and head-to-head wins per
+pair of players. Head-to-head counters are named after the players' names
+rather than their keys, so they survive the user key migration. Wins and
+games played per user are the counters User keeps.
+Stats are read from those counters alone, never from the Scores.
+"""
+
+import datetime
+
+from protorpc import messages
+
+from . import counter
+from .user import User
+
+# most days a single stats request covers
+MAX_DAYS = 31
+
+
+def _day(date):
+    return date.strftime('%Y-%m-%d')
+
+
+def _day_names(date):
+    """Returns the names of the games and turns counters of a day"""
+    return 'games:' + _day(date), 'turns:' + _day(date)
+
+
+def _beat_name(winner, loser):
+    """Returns the name of the counter of the wins of the user named winner
+    over the user named loser. Uses the urlsafe key of each name, which is
+    ASCII and the user's key once it is keyed by name"""
+    return 'beat:{}:{}'.format(User.key_for(winner).urlsafe(),
+                               User.key_for(loser).urlsafe())
+
+
+def roll_up(score, names):
+    """Adds a finished game to the counters. names maps the players' keys
+    to their names. Joins the caller's transaction, which must stop it from
+    being counted twice"""
+    games, turns = _day_names(score.date)
+    counter.increment(games)
+    if score.turns:
+        counter.increment(turns, score.turns)
+    for loser in score.losers:
+        counter.increment(_beat_name(names[score.winner], names[loser]))
+
+
+def get_stats(days, end=None, user=None, opponent=None):
+    """Returns a StatsForm for the `days` days up to end (today by
+    default), with the totals of a user and their record against an
+    opponent when those Users are given. All counters are read at once"""
+    end = end or datetime.date.today()
+    dates = [end - datetime.timedelta(days=i)
+             for i in range(min(days, MAX_DAYS))]
+    names = [name for date in dates for name in _day_names(date)]
+    if user:
+        names.extend(user.counter_names())
+        if opponent:
+            names.append(_beat_name(user.name, opponent.name))
+            names.append(_beat_name(opponent.name, user.name))
+    counts = counter.get_counts(names)
+
+    form = StatsForm()
+    for date in dates:
+        games, turns = _day_names(date)
+        day = DayStatsForm(date=_day(date), games=counts[games],
+                           turns=counts[turns])
+        if counts[games]:
+            day.average_turns = counts[turns] / float(counts[games])
+        form.days.append(day)
+    if user:
+        wins, played = user.totals(counts)
+        form.wins = wins
+        form.total_played = played
+        if opponent:
+            form.wins_against = counts[_beat_name(user.name, opponent.name)]
+            form.losses_against = counts[
+                _beat_name(opponent.name, user.name)]
+    return form
+
+
+class DayStatsForm(messages.Message):
+    """Games finished on a day and their average length in turns"""
+    date = messages.StringField(1, required=True)
+    games = messages.IntegerField(2, required=True)
+    turns = messages.IntegerField(3, required=True)
+    average_turns = messages.FloatField(4)
+
+
+class StatsForm(messages.Message):
+    """Daily stats, newest first, and a user's totals and head-to-head
+    record when asked for"""
+    days = messages.MessageField(DayStatsForm, 1, repeated=True)
+    wins = messages.IntegerField(2)
+    total_played = messages.IntegerField(3)
+    wins_against = messages.IntegerField(4)
+    losses_against = messages.IntegerField(5)
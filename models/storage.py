@@ -0,0 +1,120 @@
+"""storage.py - storage backends for the game logic of the Zombie Dice game.
+
+Game.new_game, Game.end_turn, Game.end_game, Turn.take_turn and Turn.end_turn
+read and write through the current storage instead of calling ndb directly.
+The app uses NdbStorage. MemoryStorage keeps the entities in a dict, so
+simulations and offline tournaments can play the real rules at in-process
+speed without the datastore or its stubs:
+
+    storage.set_storage(storage.MemoryStorage())
+"""
+
+import itertools
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+
+class NdbStorage(object):
+    """Reads and writes the datastore"""
+
+    def get(self, key):
+        return key.get()
+
+    def get_multi(self, keys):
+        return ndb.get_multi(keys)
+
+    def put_multi(self, entities):
+        return ndb.put_multi(entities)
+
+    def delete_multi(self, keys):
+        ndb.delete_multi(keys)
+
+    def allocate_id(self, model, parent=None):
+        return model.allocate_ids(size=1, parent=parent)[0]
+
+    def transaction(self, func):
+        """Runs func in a cross-group transaction, retrying on contention"""
+        return ndb.transaction(func, xg=True)
+
+    def add_task(self, url, params):
+        """Queues a push task that only runs if the caller's transaction
+        commits"""
+        taskqueue.add(url=url, params=params, transactional=True)
+
+    def add_pull_task(self, queue, payload, tag):
+        """Queues a pull task that only exists if the caller's transaction
+        commits"""
+        taskqueue.Queue(queue).add(
+            taskqueue.Task(payload=payload, method='PULL', tag=tag),
+            transactional=True)
+
+
+class MemoryStorage(object):
+    """Keeps entities in a dict keyed by ndb.Key. Puts assign ids to
+    incomplete keys and run _pre_put_hook like ndb does; the post hooks,
+    which only update memcache, are skipped. Entities are stored and
+    returned as protocol buffer copies, like the datastore, so changes to
+    an entity only count once it is put, and a transaction that raises
+    undoes them. Queued tasks are collected in tasks instead of running"""
+
+    def __init__(self):
+        self.entities = {}
+        self.tasks = []
+        self._ids = itertools.count(1)
+        self._adapter = ndb.ModelAdapter()
+
+    def get(self, key):
+        return self.get_multi([key])[0]
+
+    def get_multi(self, keys):
+        return [self._adapter.pb_to_entity(self.entities[key])
+                if key in self.entities else None for key in keys]
+
+    def put_multi(self, entities):
+        for entity in entities:
+            if entity.key is None:
+                entity.key = ndb.Key(entity._get_kind(), next(self._ids))
+            elif entity.key.id() is None:
+                entity.key = ndb.Key(entity._get_kind(), next(self._ids),
+                                     parent=entity.key.parent())
+            entity._pre_put_hook()
+            self.entities[entity.key] = self._adapter.entity_to_pb(entity)
+        return [entity.key for entity in entities]
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self.entities.pop(key, None)
+
+    def allocate_id(self, model, parent=None):
+        return next(self._ids)
+
+    def transaction(self, func):
+        """Runs func, undoing its puts, deletes and tasks if it raises"""
+        entities = dict(self.entities)
+        tasks = len(self.tasks)
+        try:
+            return func()
+        except Exception:
+            self.entities = entities
+            del self.tasks[tasks:]
+            raise
+
+    def add_task(self, url, params):
+        self.tasks.append((url, params))
+
+    def add_pull_task(self, queue, payload, tag):
+        self.tasks.append((queue, payload, tag))
+
+
+_STORAGE = NdbStorage()
+
+
+def get_storage():
+    """Returns the storage the game logic currently uses"""
+    return _STORAGE
+
+
+def set_storage(storage):
+    global _STORAGE
+    _STORAGE = storage
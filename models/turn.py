@@ -1,46 +1,132 @@
 """turn.py - turn-related class definitions for the Zombie Dice game."""
-import random
+import endpoints
 from protorpc import messages
+from google.appengine.api import datastore_errors
 from google.appengine.ext import ndb
 
-class Turn(ndb.Model):
+import advisor
+import cache
+import engine
+from utils import get_multi_dict, key_from_urlsafe
+from .advice import AdviceForm
+from .storage import get_storage
+
+# keep a Turn entity for every finished turn of a seeded game as well as
+# its game log entry, for code that queries Turns
+ARCHIVE_TURNS = False
+
+class Turn(cache.CachedModel):
     """Works to track each turn"""
 
     player = ndb.KeyProperty(required=True)  # The User whose turn it is
     game = ndb.KeyProperty(required=True)  # The Game the turn is a part of
     turn_over = ndb.BooleanProperty(default=False)
-    cup = ndb.PickleProperty(required=True)
-    pool = ndb.PickleProperty(required=True)
+    dice = ndb.IntegerProperty(default=engine.START)  # packed cup and pool
+    # pickled dice lists written before the dice were packed, read only
+    cup = ndb.PickleProperty()
+    pool = ndb.PickleProperty()
     green_used = ndb.IntegerProperty(default=0)
     yellow_used = ndb.IntegerProperty(default=0)
     red_used = ndb.IntegerProperty(default=0)
     brains = ndb.IntegerProperty(default=0)
     shots = ndb.IntegerProperty(default=0)
+    # the dice of a turn follow from the game's seed, its number in the
+    # game and how many rolls it has taken, see engine.replay_turn
+    number = ndb.IntegerProperty(indexed=False)
+    seed = ndb.IntegerProperty(indexed=False)
+    rolls = ndb.IntegerProperty(default=0, indexed=False)
+    # True for the active turn of a game that embeds it, see Game.turn_rolls
+    _embedded = False
+    # the game's turn_rolls when an embedded turn was loaded
+    _loaded_rolls = None
 
     @classmethod
-    def new_turn(cls, user, game):
-        """Creates a new turn"""
-        g = ("green", ["brain", "brain", "brain", "foot", "foot", "shot"])
-        y = ("yellow", ["brain", "brain", "foot", "foot", "shot", "shot"])
-        r = ("red", ["brain", "foot", "foot", "shot", "shot", "shot"])
-        turn_id = Turn.allocate_ids(size=1, parent=game)[0]
+    def new_turn(cls, user, game, number=0, seed=None):
+        """Creates a new turn. The caller puts it"""
+        if seed is None:
+            # games from before the decision log have no seed
+            turn_id = get_storage().allocate_id(Turn, parent=game)
+            key = ndb.Key(Turn, turn_id, parent=game)
+        else:
+            key = cls.key_for(game, number)
         turn = Turn(player=user,
                     game=game,
-                    cup=[g, g, g, g, g, g,
-                         y, y, y, y,
-                         r, r, r],
-                    pool=[],
-                    key=ndb.Key(Turn, turn_id, parent=game),)
-        turn.put()
+                    number=number,
+                    seed=seed,
+                    key=key,)
+        return turn
+
+    @classmethod
+    def key_for(cls, game, number):
+        """Returns the key of turn `number` of a seeded game"""
+        return ndb.Key(cls, number + 1, parent=game)
+
+    @classmethod
+    def replay(cls, game, number, rolls, turn_over=True):
+        """Rebuilds an unsaved Turn of a seeded game from its game log"""
+        turn = Turn(player=game.players[number % len(game.players)],
+                    game=game.key,
+                    turn_over=turn_over,
+                    number=number,
+                    seed=game.seed,
+                    rolls=rolls,
+                    key=cls.key_for(game.key, number))
+        turn.state = engine.replay_turn(game.seed, number, rolls)
+        return turn
+
+    @classmethod
+    def embedded(cls, game):
+        """Builds the active turn of a game that embeds it"""
+        turn = cls.replay(game, game.turn_count, game.turn_rolls,
+                          turn_over=False)
+        turn._embedded = True
+        turn._loaded_rolls = game.turn_rolls
         return turn
 
-    def to_form(self):
-        """Returns a TurnForm representation of the Turn"""
-        form = TurnForm(player=self.player.get().name,
-                        game=str(self.game.get().key.urlsafe()),
+    @classmethod
+    def load(cls, key):
+        """Returns the Turn with the given key, or None. Reads the turn and
+        its game with one get_multi, since the active turn of a game that
+        embeds it has no entity of its own"""
+        if key.kind() != cls._get_kind() or key.parent() is None:
+            return None
+        turn, game = get_storage().get_multi([key, key.parent()])
+        return cls.from_entities(key, turn, game)
+
+    @classmethod
+    def from_entities(cls, key, turn, game):
+        """Returns the Turn for a key given the entities read for the key
+        and for its parent game, or None. The next turn of a finished game
+        is never returned, since it can't be played"""
+        if game is not None and getattr(game, 'game_over', False):
+            if isinstance(turn, Turn) and turn.turn_over:
+                return turn
+            return None
+        if isinstance(turn, Turn):
+            return turn
+        if (game is not None and getattr(game, 'turn_rolls', None)
+                is not None and game.next_turn == key):
+            return cls.embedded(game)
+        return None
+
+    @classmethod
+    def to_forms(cls, turns):
+        """Returns TurnForms for a list of Turns, reading the names of their
+        players with at most a single get_multi"""
+        names = cache.get_names([turn.player for turn in turns],
+                                get_storage().get_multi)
+        return [turn.to_form(names) for turn in turns]
+
+    def to_form(self, names=None):
+        """Returns a TurnForm representation of the Turn. names maps player
+        keys to their names, see cache.get_names"""
+        if names is None:
+            names = cache.get_names([self.player], get_storage().get_multi)
+        form = TurnForm(player=names[self.player],
+                        game=str(self.game.urlsafe()),
                         turn_key=str(self.key.urlsafe()),
                         turn_over=self.turn_over,
-                        pool=str(self.pool),
+                        pool=str(self.state.pool_names()),
                         green_used=self.green_used,
                         yellow_used=self.yellow_used,
                         red_used=self.red_used,
@@ -48,74 +134,289 @@ class Turn(ndb.Model):
                         shots=self.shots)
         return form
 
-    def take_turn(self):
-        """Take a turn, modifying the turn object and returning a TurnForm."""
-        # populate the dice pool with three random dice from the cup
-
-        while len(self.pool) < 3:
-            die = self.cup.pop(random.randint(0, len(self.cup) - 1))
-            self.pool.append(die)
-        # make a copy of the pool so we can modify as we go.
-
-        for item in self.pool[:]:
-            # roll each item, returning a result like ("green", "brain")
-            result = (item[0], item[1][(random.randint(0, 5))])
-            if result[1] == "brain":
-                self.brains += 1
-                # only add to color_used if the result is a brain or shot
-                if result[0] == "green":
-                    self.green_used += 1
-                if result[0] == "red":
-                    self.red_used += 1
-                if result[0] == "yellow":
-                    self.yellow_used += 1
-                self.pool.remove(item)
-            if result[1] == "shot":
-                self.shots += 1
-                # feel like I'm violating DRY principle but not sure how to fix
-                if result[0] == "green":
-                    self.green_used += 1
-                if result[0] == "red":
-                    self.red_used += 1
-                if result[0] == "yellow":
-                    self.yellow_used += 1
-                self.pool.remove(item)
-        self.put()
+    @property
+    def state(self):
+        """Returns the engine.TurnState of the turn"""
+        dice = self.dice
+        if self.cup is not None:
+            dice = self._legacy_dice()
+        return engine.TurnState(dice=dice,
+                                used=(self.green_used,
+                                      self.yellow_used,
+                                      self.red_used),
+                                brains=self.brains,
+                                shots=self.shots)
+
+    @state.setter
+    def state(self, state):
+        self.dice = state.dice
+        self.cup = self.pool = None
+        self.green_used, self.yellow_used, self.red_used = state.used
+        self.brains = state.brains
+        self.shots = state.shots
+
+    def _legacy_dice(self):
+        """Packs the pickled ("green", [faces]) lists of older turns"""
+        cup = [0, 0, 0]
+        for color, faces in self.cup:
+            cup[engine.COLORS.index(color)] += 1
+        pool = [engine.COLORS.index(color) for color, faces in self.pool]
+        pool += [engine.EMPTY] * (engine.POOL_SIZE - len(pool))
+        return engine.pack(cup, pool)
+
+    def _roll(self, state):
+        """Rolls the turn's state once, drawing from the game's seed if it
+        has one. Returns the result as a readable string"""
+        if self.seed is None:
+            rolled = state.roll()
+        else:
+            rolled = state.roll(
+                engine.roll_rng(self.seed, self.number, self.rolls))
+        self.rolls += 1
+        return ', '.join(
+            '{} {}'.format(engine.COLORS[color], engine.FACES[face])
+            for color, face in rolled)
+
+    def take_turn(self, max_rolls=1, until_brains=None, until_shots=None,
+                  stop=False):
+        """Take a turn, modifying the turn object and returning a TurnForm.
+        Rolls up to max_rolls times, stopping early once the turn holds
+        until_brains brains or until_shots shots. If stop is set the turn is
+        then ended. The turn is written once, however many rolls it took."""
+        state = self.state
+        results = []
+        for _ in range(max_rolls):
+            results.append(self._roll(state))
+            if state.busted or not state.can_roll:
+                break
+            if until_brains is not None and state.brains >= until_brains:
+                break
+            if until_shots is not None and state.shots >= until_shots:
+                break
+        self.state = state
         # If shots on the current turn are 3 or more, immediately end the turn.
-        if self.shots > 2:
-            self.brains = 0
-            return self.end_turn()
-        return self.to_form()
+        if state.busted or stop:
+            form = self.end_turn()
+        else:
+            self._save(get_storage())
+            form = self.to_form()
+        form.roll_results = results
+        return form
+
+    def advise(self):
+        """Returns an AdviceForm for the next roll of the turn"""
+        bust, stop, roll = advisor.advise(self.state)
+        return AdviceForm(turn_key=self.key.urlsafe(),
+                          bust_probability=bust,
+                          stop_brains=stop,
+                          roll_brains=roll,
+                          roll=roll > stop)
 
     # a player can either be forced to end their turn, or choose to do so
     def end_turn(self):
-        """Ends the current turn, then tells the game to start a new turn."""
+        """Ends the current turn, then tells the game to start a new turn.
+        Raises a ValueError if the game has already moved on"""
 
         self.turn_over = True
-        self.put()
-        self.game.get().end_turn(self)
+        storage = get_storage()
+        storage.transaction(lambda: self._commit_end(storage))
         return self.to_form()
 
+    def _save(self, storage):
+        """Writes a turn that is still going on"""
+        if not self._embedded:
+            storage.transaction(lambda: self._put_in(storage.get(self.game),
+                                                     storage))
+            return
+        storage.transaction(lambda: self._save_in(storage.get(self.game),
+                                                  storage))
+        self._loaded_rolls = self.rolls
+
+    @ndb.transactional_tasklet
+    def _save_async(self):
+        """Like _save, for many turns in parallel. Always uses the
+        datastore"""
+        game = yield self.game.get_async()
+        if self._embedded:
+            self._save_in(game)
+            yield game.put_async()
+        else:
+            self._check(game)
+            yield self.put_async()
+
+    def _put_in(self, game, storage):
+        """Puts a turn that has an entity of its own, unless its game has
+        moved on"""
+        self._check(game)
+        storage.put_multi([self])
+
+    def _save_in(self, game, storage=None):
+        """Copies the rolls of an embedded turn onto its game, and puts the
+        game if a storage is given"""
+        self._check(game)
+        game.turn_rolls = self.rolls
+        if storage is not None:
+            storage.put_multi([game])
+
+    def _commit_end(self, storage):
+        """Writes the turn and everything Game.end_turn changes. Runs in a
+        transaction, so no request sees a half-ended turn"""
+        put, delete = self._end_in(storage.get(self.game))
+        storage.put_multi(put)
+        storage.delete_multi(delete)
+
+    def _end_in(self, game):
+        """Ends the turn in its game.
+        Returns:
+            A (entities to put, keys to delete) tuple.
+        Raises:
+            ValueError: if the game has already moved on."""
+        self._check(game)
+        changed = game.end_turn(self)
+        if self.seed is None or ARCHIVE_TURNS:
+            return [self] + changed, []
+        if self._embedded:
+            return changed, []
+        # the game log holds the finished turn from now on
+        return changed, [self.key]
+
+    def _check(self, game):
+        """Raises a ValueError unless the turn is still the game's next
+        turn, in the state it was loaded in. Called in the transaction
+        that commits the turn"""
+        if game is None or game.game_over or game.next_turn != self.key:
+            raise ValueError('This turn is over!')
+        if self._embedded and game.turn_rolls != self._loaded_rolls:
+            raise ValueError('This turn has changed since it was read, '
+                             'try again')
+
+    @classmethod
+    def take_turns(cls, actions):
+        """Applies a batch of (urlsafe turn key, roll) actions, usually on
+        turns of different games. The turns and their games are read with
+        one get_multi and rolled turns commit in parallel, each in its own
+        transaction that checks the turn against its game. Ended turns
+        commit one transaction at a time:
+        ending a game queues transactional tasks, which the datastore API
+        would attach to whichever of the parallel transactions ran last.
+        Returns:
+            A TurnForm per action, in order. Actions that could not be
+            applied get a form with only turn_key and error set."""
+        errors = {}
+        keys = []
+        for i, (urlsafe, roll) in enumerate(actions):
+            try:
+                key = key_from_urlsafe(urlsafe)
+            except endpoints.BadRequestException as e:
+                errors[i] = str(e)
+                key = None
+            if key is not None and key in keys:
+                errors[i] = 'Turn is in the batch more than once'
+                key = None
+            keys.append(key)
+        found = get_multi_dict(keys + [key.parent() for key in keys
+                                       if key is not None])
+
+        turns = {}
+        committing = {}
+        ending = []
+        for i, (urlsafe, roll) in enumerate(actions):
+            if i in errors:
+                continue
+            key = keys[i]
+            turn = None
+            if key.kind() == cls._get_kind() and key.parent() is not None:
+                turn = cls.from_entities(key, found[key],
+                                         found[key.parent()])
+            if turn is None:
+                errors[i] = 'Turn not found or over'
+            elif turn.turn_over:
+                errors[i] = 'This turn is over!'
+            elif roll and not turn.state.can_roll:
+                errors[i] = 'No dice left to roll!'
+            if i in errors:
+                continue
+            turns[i] = turn
+            if roll:
+                state = turn.state
+                turn._roll(state)
+                turn.state = state
+                if state.busted:
+                    # If shots are 3 or more, immediately end the turn.
+                    roll = False
+                else:
+                    committing[i] = turn._save_async()
+            if not roll:
+                turn.turn_over = True
+                ending.append(i)
+
+        def attempt(i, commit):
+            try:
+                commit()
+            except ValueError as e:
+                # another request changed or ended this turn first
+                errors[i] = str(e)
+            except datastore_errors.TransactionFailedError:
+                errors[i] = 'Too much contention on this game, try again'
+
+        for i, future in committing.items():
+            attempt(i, future.get_result)
+        # only once the parallel transactions are done
+        storage = get_storage()
+        for i in ending:
+            attempt(i, lambda: storage.transaction(
+                lambda: turns[i]._commit_end(storage)))
+
+        names = cache.get_names([turn.player for turn in turns.values()])
+        forms = []
+        for i, (urlsafe, roll) in enumerate(actions):
+            if i in errors:
+                forms.append(TurnForm(turn_key=urlsafe, error=errors[i]))
+            else:
+                forms.append(turns[i].to_form(names))
+        return forms
+
 
 class TurnForm(messages.Message):
-    """Used to report turn status"""
-    player = messages.StringField(1, required=True)
-    game = messages.StringField(2, required=True)
+    """Used to report turn status. A batch action that failed only sets
+    turn_key and error"""
+    player = messages.StringField(1)
+    game = messages.StringField(2)
     turn_key = messages.StringField(3, required=True)
-    turn_over = messages.BooleanField(4, required=True)
-    pool = messages.StringField(5, required=True)
-    green_used = messages.IntegerField(6, required=True)
-    yellow_used = messages.IntegerField(7, required=True)
-    red_used = messages.IntegerField(8, required=True)
-    brains = messages.IntegerField(9, required=True)
-    shots = messages.IntegerField(10, required=True)
+    turn_over = messages.BooleanField(4)
+    pool = messages.StringField(5)
+    green_used = messages.IntegerField(6)
+    yellow_used = messages.IntegerField(7)
+    red_used = messages.IntegerField(8)
+    brains = messages.IntegerField(9)
+    shots = messages.IntegerField(10)
+    roll_results = messages.StringField(11, repeated=True)
+    error = messages.StringField(12)
 
 
 class TurnForms(messages.Message):
     """Return multiple TurnForms"""
     items = messages.MessageField(TurnForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class TakeTurnForm(messages.Message):
-    """Used to take a turn"""
-    roll = messages.BooleanField(1, required=True)
\ No newline at end of file
+    """Used to take a turn. With any of until_brains, until_shots or
+    max_rolls set, a roll keeps rolling until one of them is reached, and
+    stop then ends the turn"""
+    roll = messages.BooleanField(1, required=True)
+    until_brains = messages.IntegerField(2)
+    until_shots = messages.IntegerField(3)
+    max_rolls = messages.IntegerField(4)
+    stop = messages.BooleanField(5, default=False)
+
+
+class TurnActionForm(messages.Message):
+    """One action of a batch: roll the turn once, or end it"""
+    urlsafe_turn_key = messages.StringField(1, required=True)
+    roll = messages.BooleanField(2, required=True)
+
+
+class TurnActionForms(messages.Message):
+    """Used to act on many turns at once"""
+    items = messages.MessageField(TurnActionForm, 1, repeated=True)
\ No newline at end of file
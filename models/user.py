@@ -1,41 +1,306 @@
 """user.py - class definitions for user-related classes for Zombie Dice Game"""
 
+import time
+
 from protorpc import messages
+from google.appengine.api import memcache, taskqueue
 from google.appengine.ext import ndb
 
-class User(ndb.Model):
-    """User Profile"""
+import cache
+from . import counter
+
+# users need this many finished games to appear in the rankings
+MIN_RANKED_GAMES = 1
+# seconds a cached "users above this win percentage" count is reused
+RANK_CACHE_TIME = 60
+# ranked users are counted in this many equal win percentage buckets
+RANK_BUCKETS = 100
+# seconds of game results gathered into a single write of a User's totals
+SYNC_DELAY = 60
+
+
+def _percentage(wins, played):
+    if played > 0:
+        return float(wins) / float(played)
+    else:
+        return float(0)
+
+
+def _win_percentage(user):
+    return _percentage(user.wins, user.total_played)
+
+
+def _bucket(percentage):
+    """Returns the rank bucket of a win percentage"""
+    return min(int(percentage * RANK_BUCKETS), RANK_BUCKETS - 1)
+
+
+def _bucket_name(bucket):
+    """Returns the name of the counter of the ranked users in a bucket"""
+    return 'rank-bucket:{}'.format(bucket)
+
+
+def _counter_names(key):
+    """Returns the names of the wins and games played counters of a user.
+    Named after the urlsafe key, which is ASCII for any user name and
+    tells a name made of digits from a legacy id"""
+    return 'wins:' + key.urlsafe(), 'played:' + key.urlsafe()
+
+
+class User(cache.CachedModel):
+    """User Profile. Game results go to sharded counters; wins and
+    total_played are a copy of the counter totals, synced every
+    SYNC_DELAY seconds for the rankings index"""
     name = ndb.StringProperty(required=True)
     email = ndb.StringProperty()
     wins = ndb.IntegerProperty(default=0)
     total_played = ndb.IntegerProperty(default=0)
+    # True once the wins and total_played recorded before the counters
+    # existed have been added to them
+    sharded = ndb.BooleanProperty(default=False)
+    # stored so the rankings can be served straight from the index
+    win_percentage = ndb.ComputedProperty(_win_percentage)
+    ranked = ndb.ComputedProperty(
+        lambda self: self.total_played >= MIN_RANKED_GAMES)
+    # the rank bucket this user is counted in, None while unranked
+    rank_bucket = ndb.IntegerProperty()
+
+    @staticmethod
+    def normalize(name):
+        """Returns the form of a user name that Users are keyed by, so
+        names differing only in case or surrounding spaces are the same"""
+        return name.strip().lower()
+
+    @classmethod
+    def key_for(cls, name):
+        return ndb.Key(cls, cls.normalize(name))
+
+    @classmethod
+    def create(cls, name, email=None):
+        """Creates and returns a User, keyed by its normalized name.
+        Raises a ValueError if the name is taken"""
+        if cls._legacy_key(name):
+            raise ValueError('A User with that name already exists.')
+        return cls._insert(name, email)
 
-    @property
-    def win_percentage(self):
-        if self.total_played > 0:
-            return float(self.wins) / float(self.total_played)
-        else:
-            return float(0)
+    @classmethod
+    @ndb.transactional
+    def _insert(cls, name, email):
+        key = cls.key_for(name)
+        if key.get():
+            raise ValueError('A User with that name already exists.')
+        # new users have no totals from before the counters
+        user = cls(key=key, name=name, email=email, sharded=True)
+        user.put()
+        return user
 
-    def to_form(self):
+    @classmethod
+    def get_by_names(cls, names):
+        """Returns the User for each name in a list, or None for names
+        nobody has, with a single get_multi"""
+        users = ndb.get_multi([cls.key_for(name) for name in names])
+        for i, name in enumerate(names):
+            if users[i] is None:
+                users[i] = cls._legacy_key(name, keys_only=False)
+        return users
+
+    @classmethod
+    def _legacy_key(cls, name, keys_only=True):
+        """Looks a name up among the Users created before Users were keyed
+        by name. Only finds anything until MigrateUserKeys has run"""
+        return cls.query(cls.name == name).get(keys_only=keys_only)
+
+    @classmethod
+    def rankings(cls):
+        """Returns a query for ranked Users, best first. Ties on win
+        percentage go to the user with more wins, then by name"""
+        return cls.query(cls.ranked == True).order(
+            -cls.win_percentage, -cls.wins, cls.name)
+
+    @classmethod
+    def ranks(cls, users):
+        """Returns the rank of each user in a list. Users with the same win
+        percentage share a rank; unranked users get None. Costs one read
+        of the bucket counters plus one count per distinct percentage that
+        only scans the users in its own bucket"""
+        percentages = set(user.win_percentage for user in users
+                          if user.ranked)
+        above = dict(zip(percentages, cls._count_above(list(percentages))))
+        return [above[user.win_percentage] + 1 if user.ranked else None
+                for user in users]
+
+    @classmethod
+    def _count_above(cls, percentages):
+        """Counts the ranked users above each win percentage: the ones in
+        higher buckets from the bucket counters, plus the ones above it in
+        its own bucket. Reuses counts cached in memcache and runs the
+        missing ones in parallel"""
+        keys = ['rank:{!r}'.format(p) for p in percentages]
+        cached = memcache.get_multi(keys)
+        missing = [(key, percentage)
+                   for key, percentage in zip(keys, percentages)
+                   if key not in cached]
+        if not missing:
+            return [cached[key] for key in keys]
+        # only the buckets above the lowest one asked about are needed
+        lowest = min(_bucket(percentage) for _, percentage in missing)
+        histogram = counter.get_counts(
+            [_bucket_name(bucket)
+             for bucket in range(lowest + 1, RANK_BUCKETS)])
+        futures = {}
+        for key, percentage in missing:
+            bucket = _bucket(percentage)
+            higher = sum(histogram[_bucket_name(b)]
+                         for b in range(bucket + 1, RANK_BUCKETS))
+            futures[key] = higher, cls.query(
+                cls.rank_bucket == bucket,
+                cls.win_percentage > percentage).count_async()
+        counts = dict((key, higher + future.get_result())
+                      for key, (higher, future) in futures.items())
+        if counts:
+            memcache.set_multi(counts, time=RANK_CACHE_TIME)
+        cached.update(counts)
+        return [cached[key] for key in keys]
+
+    @classmethod
+    def to_forms(cls, users, ranks=None):
+        """Returns UserForms for a page of Users with the totals synced
+        onto them, which the rankings are sorted by, instead of reading
+        the counters of every user on the page"""
+        ranks = ranks or [None] * len(users)
+        return [user.to_form(rank, (user.wins, user.total_played))
+                for user, rank in zip(users, ranks)]
+
+    def to_form(self, rank=None, totals=None):
+        """Returns a UserForm with the given (wins, total_played), or the
+        current counter totals"""
+        wins, played = totals or self.totals()
         return UserForm(name=self.name,
                         email=self.email,
-                        wins=self.wins,
-                        total_played=self.total_played,
-                        win_percentage=self.win_percentage)
+                        wins=wins,
+                        total_played=played,
+                        win_percentage=_percentage(wins, played),
+                        rank=rank)
+
+    def counter_names(self):
+        """Returns the names of the user's wins and games played counters,
+        to read them along with other counters and pass the result to
+        totals"""
+        return _counter_names(self.key)
 
-    def add_win(self):
+    def totals(self, counts=None):
+        """Returns (wins, total_played) from the counters. counts is a dict
+        of already read counter totals"""
+        names = self.counter_names()
+        if counts is None:
+            counts = counter.get_counts(names)
+        wins, played = counts[names[0]], counts[names[1]]
+        if not self.sharded:
+            wins += self.wins
+            played += self.total_played
+        return wins, played
+
+    @classmethod
+    def add_win(cls, key):
         """Add a win"""
-        self.wins += 1
-        self.total_played += 1
-        self.put()
+        wins, played = _counter_names(key)
+        counter.increment(wins)
+        counter.increment(played)
 
-    def add_loss(self):
+    @classmethod
+    def add_loss(cls, key):
         """Add a loss"""
-        self.total_played += 1
-        self.put()
+        wins, played = _counter_names(key)
+        counter.increment(played)
+
+    @classmethod
+    def queue_sync(cls, key):
+        """Queues a write of the user's counter totals at the end of the
+        current SYNC_DELAY window. Further calls in the window are dropped,
+        so a user finishing many games is written once per window"""
+        window = int(time.time()) // SYNC_DELAY
+        try:
+            taskqueue.add(url='/tasks/sync_user',
+                          params={'user_key': key.urlsafe()},
+                          name='sync-{}-{}'.format(key.urlsafe(), window),
+                          countdown=SYNC_DELAY)
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
+
+    @classmethod
+    def sync(cls, key):
+        """Copies the counter totals onto the User"""
+        if not key.get():
+            # moved to its name key by MigrateUserKeys since being queued
+            return
+        cls._move_to_counters(key)
+        wins, played = _counter_names(key)
+        counts = counter.get_counts([wins, played], cached=False)
+        cls._write_totals(key, counts[wins], counts[played])
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def _write_totals(cls, key, wins, played):
+        user = key.get()
+        user.wins = wins
+        user.total_played = played
+        user._rebucket()
+        user.put()
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def reindex(cls, key):
+        """Rewrites a User so its stored ranking properties are indexed
+        and it is counted in the bucket of its win percentage"""
+        user = key.get()
+        if user:
+            user._rebucket()
+            user.put()
+
+    def _rebucket(self):
+        """Moves the user's count to the bucket of its current win
+        percentage. Must run in the transaction that puts the User"""
+        bucket = _bucket(self.win_percentage) if self.ranked else None
+        if bucket == self.rank_bucket:
+            return
+        if self.rank_bucket is not None:
+            counter.increment(_bucket_name(self.rank_bucket), -1)
+        if bucket is not None:
+            counter.increment(_bucket_name(bucket))
+        self.rank_bucket = bucket
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def _move_to_counters(cls, key):
+        """Adds the totals stored on a User from before the counters
+        existed to its counters, once"""
+        user = key.get()
+        if user.sharded:
+            return
+        wins, played = _counter_names(key)
+        counter.increment(wins, user.wins)
+        counter.increment(played, user.total_played)
+        user.sharded = True
+        user.put()
+
+    @classmethod
+    def move_counters(cls, old, new):
+        """Moves the counter totals of the User with key old onto the User
+        with key new"""
+        old_names, new_names = _counter_names(old), _counter_names(new)
+        counts = counter.get_counts(old_names, cached=False)
+        cls._shift_counts(zip(old_names, new_names), counts)
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def _shift_counts(cls, pairs, counts):
+        for old_name, new_name in pairs:
+            if counts[old_name]:
+                counter.increment(new_name, counts[old_name])
+                counter.increment(old_name, -counts[old_name])
+
 
-        
 class UserForm(messages.Message):
     """User Form"""
     name = messages.StringField(1, required=True)
@@ -44,8 +309,10 @@ class UserForm(messages.Message):
     wins = messages.IntegerField(4)
     total_played = messages.IntegerField(5, required=True)
     win_percentage = messages.FloatField(6, required=True)
+    rank = messages.IntegerField(7)
 
 
 class UserForms(messages.Message):
     """Container for multiple User Forms"""
-    items = messages.MessageField(UserForm, 1, repeated=True)
\ No newline at end of file
+    items = messages.MessageField(UserForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
\ No newline at end of file
@@ -0,0 +1,210 @@
+"""simulate.py - vectorized Monte Carlo simulator for the Zombie Dice game.
+
+Rolls whole batches of turns or games at once with NumPy, using the dice
+tables from engine.py and the same scoring rules as engine.score_turn (which
+Game.end_turn applies). It is an offline tool and is not imported by the app.
+
+    python simulate.py turns --brains 5
+    python simulate.py games --players 4 --shots 2
+    python simulate.py bench
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+import engine
+
+_DICE = np.array(engine.DICE)
+_CUP = np.array(engine.CUP)
+
+# a game that outlasts this many rounds is left without a winner
+MAX_ROUNDS = 100
+
+
+def keep_rolling(brains=None, shots=engine.MAX_SHOTS):
+    """Returns a policy that keeps rolling until the turn holds at least
+    `brains` brains or `shots` shots. A policy is called with the brains,
+    shots and dice left of every running turn and returns a bool array that
+    is True where the turn should roll again."""
+    def policy(turn_brains, turn_shots, dice_left):
+        roll = turn_shots < shots
+        if brains is not None:
+            roll &= turn_brains < brains
+        return roll
+    return policy
+
+
+class TurnResults(object):
+    """Outcome of a batch of simulated turns"""
+
+    def __init__(self, brains, busted, rolls):
+        self.brains = brains
+        self.busted = busted
+        self.rolls = rolls
+
+    def __len__(self):
+        return len(self.brains)
+
+    @property
+    def bust_rate(self):
+        return float(self.busted.mean())
+
+    def distribution(self):
+        """Returns the fraction of turns that banked each number of brains"""
+        return np.bincount(self.brains) / float(len(self))
+
+    def report(self):
+        return {'turns': len(self),
+                'mean_brains': float(self.brains.mean()),
+                'bust_rate': self.bust_rate,
+                'mean_rolls': float(self.rolls.mean()),
+                'brains': self.distribution().round(4).tolist()}
+
+
+class GameResults(object):
+    """Outcome of a batch of simulated games"""
+
+    def __init__(self, scores, winners, turns):
+        self.scores = scores
+        self.winners = winners
+        self.turns = turns
+
+    def __len__(self):
+        return len(self.winners)
+
+    def win_rates(self):
+        """Returns the fraction of games won from each seat"""
+        players = self.scores.shape[1]
+        won = np.bincount(self.winners[self.winners >= 0], minlength=players)
+        return won / float(len(self))
+
+    def report(self):
+        return {'games': len(self),
+                'win_rates': self.win_rates().round(4).tolist(),
+                'mean_scores': self.scores.mean(axis=0).round(2).tolist(),
+                'unfinished': int((self.winners < 0).sum()),
+                'mean_turns': float(self.turns.mean())}
+
+
+def simulate_turns(n, policy, rng=None):
+    """Plays n turns side by side, asking the policy before every roll.
+    Returns:
+        A TurnResults with the banked brains (0 on a bust) of every turn."""
+    rng = np.random.default_rng(rng)
+    cup = np.tile(_CUP, (n, 1))
+    pool = np.full((n, engine.POOL_SIZE), engine.EMPTY)
+    brains = np.zeros(n, dtype=int)
+    shots = np.zeros(n, dtype=int)
+    rolls = np.zeros(n, dtype=int)
+    running = np.ones(n, dtype=bool)
+
+    while True:
+        left = cup.sum(axis=1) + (pool != engine.EMPTY).sum(axis=1)
+        idx = np.flatnonzero(running & (left > 0))
+        if idx.size:
+            wants = policy(brains[idx], shots[idx], left[idx])
+            running[idx[~wants]] = False
+            idx = idx[wants]
+        if not idx.size:
+            break
+        rows = np.arange(idx.size)
+        c = cup[idx]
+        p = pool[idx]
+
+        # draw a die weighted by the colors left in the cup for empty slots
+        for slot in range(engine.POOL_SIZE):
+            total = c.sum(axis=1)
+            draw = (p[:, slot] == engine.EMPTY) & (total > 0)
+            pick = (rng.random(idx.size) * total).astype(int)
+            color = ((pick >= c[:, engine.GREEN]).astype(int) +
+                     (pick >= c[:, engine.GREEN] + c[:, engine.YELLOW]))
+            c[rows[draw], color[draw]] -= 1
+            p[draw, slot] = color[draw]
+
+        empty = p == engine.EMPTY
+        faces = _DICE[np.where(empty, 0, p),
+                      rng.integers(0, 6, size=p.shape)]
+        faces[empty] = engine.FOOT
+        brains[idx] += (faces == engine.BRAIN).sum(axis=1)
+        shots[idx] += (faces == engine.SHOT).sum(axis=1)
+        rolls[idx] += 1
+        # brains and shots are set aside, feet stay in the pool
+        p[faces != engine.FOOT] = engine.EMPTY
+        cup[idx] = c
+        pool[idx] = p
+
+        bust = idx[shots[idx] > engine.MAX_SHOTS]
+        brains[bust] = 0
+        running[bust] = False
+
+    return TurnResults(brains, shots > engine.MAX_SHOTS, rolls)
+
+
+def simulate_games(n, policies, rng=None):
+    """Plays n games side by side with one policy per seat. Scores every
+    turn the way engine.score_turn does, so a busted final player does not
+    end the game and a later 13 moves the final round on.
+    Returns:
+        A GameResults; winners is -1 for games still running after
+        MAX_ROUNDS rounds."""
+    rng = np.random.default_rng(rng)
+    players = len(policies)
+    scores = np.zeros((n, players), dtype=int)
+    final = np.full(n, -1)
+    winners = np.full(n, -1)
+    turns = np.zeros(n, dtype=int)
+
+    for turn in range(MAX_ROUNDS * players):
+        idx = np.flatnonzero(winners < 0)
+        if not idx.size:
+            break
+        seat = turn % players
+        result = simulate_turns(idx.size, policies[seat], rng)
+        turns[idx] += 1
+
+        scored = idx[~result.busted]
+        scores[scored, seat] += result.brains[~result.busted]
+        # if the last player to play was the final player, end the game
+        ended = scored[final[scored] == seat]
+        winners[ended] = scores[ended].argmax(axis=1)
+        over = scored[scores[scored, seat] >= engine.WINNING_SCORE]
+        final[over] = (seat - 1) % players
+
+    return GameResults(scores, winners, turns)
+
+
+def benchmark(n=10 ** 6, policy=None, rng=None):
+    """Returns the number of simulated turns per second"""
+    policy = policy or keep_rolling()
+    start = time.time()
+    simulate_turns(n, policy, rng)
+    return n / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('mode', choices=('turns', 'games', 'bench'))
+    parser.add_argument('-n', type=int, default=10 ** 6,
+                        help='number of turns or games to play')
+    parser.add_argument('--brains', type=int, default=None,
+                        help='stop rolling at this many brains')
+    parser.add_argument('--shots', type=int, default=engine.MAX_SHOTS,
+                        help='stop rolling at this many shots')
+    parser.add_argument('--players', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    policy = keep_rolling(args.brains, args.shots)
+    if args.mode == 'turns':
+        print(simulate_turns(args.n, policy, args.seed).report())
+    elif args.mode == 'games':
+        policies = [policy] * args.players
+        print(simulate_games(args.n, policies, args.seed).report())
+    else:
+        print('{:.0f} turns/s'.format(benchmark(args.n, policy, args.seed)))
+
+
+if __name__ == '__main__':
+    main()
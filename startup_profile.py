@@ -0,0 +1,198 @@
+"""startup_profile.py - cold start profile of the app's WSGI scripts.
+
+Imports api.py and main.py in a fresh interpreter, as a new instance does on
+its first request, timing every module they load, then times the warmup
+handler's work (api.warm_up) against the testbed stubs, with the advisor
+table already stored as it is in production. Each run is a new
+process, so nothing is imported yet; the report has the median of --runs
+runs. Python 2.7 has no -X importtime, so imports are timed by wrapping
+__import__: a module's self time excludes the modules it imports.
+
+    python startup_profile.py --sdk ~/google_appengine --out before.json
+    python startup_profile.py --sdk ~/google_appengine --compare before.json
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import timeit
+
+try:
+    import __builtin__ as builtins
+except ImportError:
+    import builtins
+
+import api_bench
+
+# the scripts app.yaml routes requests to, in the order they are imported
+SCRIPTS = ('api', 'main')
+# slowest imports listed in the report
+TOP = 15
+
+_timer = timeit.default_timer
+_import = builtins.__import__
+_stack = []
+_modules = {}
+
+
+def _name(name, globals, fromlist, module):
+    """Returns the full name of the module an __import__ call loaded"""
+    if fromlist:
+        return getattr(module, '__name__', name)
+    package = (globals or {}).get('__package__') or \
+        (globals or {}).get('__name__', '').rpartition('.')[0]
+    # Python 2 marks failed implicit relative imports with None
+    if package and sys.modules.get(package + '.' + name) is not None:
+        return package + '.' + name
+    return name
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=-1):
+    loaded = len(sys.modules)
+    start = _timer()
+    _stack.append(0.0)
+    try:
+        if level == -1 and sys.version_info[0] > 2:
+            level = 0
+        module = _import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = _timer() - start
+        children = _stack.pop()
+        if _stack:
+            _stack[-1] += elapsed
+    if len(sys.modules) > loaded:
+        full = _name(name, globals, fromlist, module)
+        if full not in _modules:
+            _modules[full] = {'ms': elapsed * 1000,
+                              'self_ms': (elapsed - children) * 1000}
+    return module
+
+
+def _store_advice_table():
+    """Stores a solved advisor table and drops it from memory, so warm_up
+    reads it like a new instance would instead of solving it"""
+    import advisor
+    from models import AdviceTable
+    AdviceTable.load()
+    advisor.set_table(None)
+
+
+def profile_once(sdk):
+    """Profiles one cold start in this process. Returns the timings"""
+    api_bench.add_sdk(sdk)
+    result = {}
+    builtins.__import__ = _timed_import
+    try:
+        for script in SCRIPTS:
+            start = _timer()
+            __import__(script)
+            result['import_' + script + '_ms'] = (_timer() - start) * 1000
+    finally:
+        builtins.__import__ = _import
+    bed = api_bench.activate_stubs()
+    try:
+        api = sys.modules['api']
+        _store_advice_table()
+        start = _timer()
+        api.warm_up()
+        result['warm_up_ms'] = (_timer() - start) * 1000
+        # a second call shows what warm_up does not keep for later calls
+        start = _timer()
+        api.warm_up()
+        result['warm_up_again_ms'] = (_timer() - start) * 1000
+    finally:
+        bed.deactivate()
+    result['modules'] = _modules
+    return result
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def profile(sdk, runs):
+    """Profiles `runs` cold starts, each in a new interpreter. Returns the
+    report of their medians"""
+    results = []
+    for _ in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, __file__, '--sdk', sdk, '--child'])
+        results.append(json.loads(output.decode('utf-8')))
+    summary = {}
+    for field in results[0]:
+        if field != 'modules':
+            summary[field] = round(_median([r[field] for r in results]), 1)
+    summary['total_ms'] = round(sum(
+        value for field, value in summary.items()
+        if field.startswith('import_') or field == 'warm_up_ms'), 1)
+    modules = {}
+    for name in results[0]['modules']:
+        times = [r['modules'][name] for r in results
+                 if name in r['modules']]
+        modules[name] = {
+            'ms': round(_median([t['ms'] for t in times]), 2),
+            'self_ms': round(_median([t['self_ms'] for t in times]), 2)}
+    summary['modules'] = modules
+    return summary
+
+
+def show(summary, top=TOP):
+    for field in sorted(summary):
+        if field != 'modules':
+            print('{:<24} {:>10}'.format(field, summary[field]))
+    print('\n{:<48} {:>10} {:>10}'.format('slowest imports', 'self ms',
+                                          'total ms'))
+    modules = summary['modules']
+    for name in sorted(modules, key=lambda n: -modules[n]['self_ms'])[:top]:
+        print('{:<48} {:>10} {:>10}'.format(
+            name, modules[name]['self_ms'], modules[name]['ms']))
+
+
+def compare(before, after, top=TOP):
+    """Prints the change in the totals and in the slowest imports between
+    two reports"""
+    for field in sorted(set(before) | set(after)):
+        if field != 'modules':
+            print('{:<24} {:>10} -> {:<10}'.format(
+                field, before.get(field, '-'), after.get(field, '-')))
+    old = before.get('modules', {})
+    new = after.get('modules', {})
+    names = sorted(set(old) | set(new), key=lambda n: -max(
+        old.get(n, {}).get('self_ms', 0), new.get(n, {}).get('self_ms', 0)))
+    print('\n{:<48} {:>22}'.format('slowest imports', 'self ms'))
+    for name in names[:top]:
+        print('{:<48} {:>10} -> {:<10}'.format(
+            name, old.get(name, {}).get('self_ms', '-'),
+            new.get(name, {}).get('self_ms', '-')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', required=True,
+                        help='path of the App Engine Python SDK')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='cold starts to take the median of')
+    parser.add_argument('--out', help='write the report to this file')
+    parser.add_argument('--compare', help='report of an earlier run')
+    parser.add_argument('--child', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(profile_once(args.sdk)))
+        return
+    summary = profile(args.sdk, args.runs)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), summary)
+    else:
+        show(summary)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""test_migration.py - tests of the one-off data migrations.
+
+Run against the SDK's testbed stubs, so they need the App Engine Python SDK:
+
+    APPENGINE_SDK=~/google_appengine python -m unittest discover tests
+"""
+
+import os
+import unittest
+
+import api_bench
+
+SDK = os.environ.get('APPENGINE_SDK')
+if SDK:
+    api_bench.add_sdk(os.path.expanduser(SDK))
+
+
+@unittest.skipUnless(SDK, 'set APPENGINE_SDK to the App Engine SDK path')
+class MigrateUserKeyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bed = api_bench.activate_stubs()
+
+    def tearDown(self):
+        self.bed.deactivate()
+
+    def test_moves_cached_counters(self):
+        from models import User
+        from models.migration import migrate_user_key
+        old = User(name='Carol').put()
+        User.add_win(old)
+        User.add_loss(old)
+        user = old.get()
+        # cached, so moving them off the old key has to update memcache
+        self.assertEqual(user.totals(), (1, 2))
+
+        new = migrate_user_key(old)
+        self.assertEqual(new, User.key_for('carol'))
+        self.assertIsNone(old.get())
+        self.assertEqual(new.get().totals(), (1, 2))
+        self.assertEqual(user.totals(), (0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
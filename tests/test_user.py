@@ -0,0 +1,57 @@
+"""test_user.py - tests of the User counters and rankings.
+
+Run against the SDK's testbed stubs, so they need the App Engine Python SDK:
+
+    APPENGINE_SDK=~/google_appengine python -m unittest discover tests
+"""
+
+import os
+import unittest
+
+import api_bench
+
+SDK = os.environ.get('APPENGINE_SDK')
+if SDK:
+    api_bench.add_sdk(os.path.expanduser(SDK))
+
+
+@unittest.skipUnless(SDK, 'set APPENGINE_SDK to the App Engine SDK path')
+class RankBucketTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bed = api_bench.activate_stubs()
+
+    def tearDown(self):
+        self.bed.deactivate()
+
+    def histogram(self, cached=True):
+        """Returns the non-empty rank buckets and their counts"""
+        from models import counter, user
+        names = dict((user._bucket_name(bucket), bucket)
+                     for bucket in range(user.RANK_BUCKETS))
+        counts = counter.get_counts(list(names), cached)
+        return dict((names[name], count)
+                    for name, count in counts.items() if count)
+
+    def test_sync_moves_user_to_new_bucket(self):
+        from models import User
+        alice = User.create('alice').key
+        bob = User.create('bob').key
+        User.add_win(alice)
+        User.add_win(bob)
+        User.sync(alice)
+        User.sync(bob)
+        self.assertEqual(self.histogram(), {99: 2})
+
+        # with the bucket totals cached, the move has to update memcache
+        User.add_loss(alice)
+        User.sync(alice)
+        self.assertEqual(self.histogram(), {50: 1, 99: 1})
+        self.assertEqual(self.histogram(cached=False), {50: 1, 99: 1})
+        users = [alice.get(), bob.get()]
+        self.assertEqual([user.rank_bucket for user in users], [50, 99])
+        self.assertEqual(User.ranks(users), [2, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
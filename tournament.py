@@ -0,0 +1,365 @@
+"""tournament.py - offline tournaments between roll/stop strategies.
+
+Plays two-player matches between strategies on every core, scoring each turn
+with engine.score_turn, the rule Game.end_turn applies, so the final round
+and the winner are decided exactly as in the app. Results are streamed to a
+compact binary file and Elo ratings are updated game by game.
+
+    python tournament.py round-robin cautious brains:4 advisor --out rr.zdt
+    python tournament.py swiss cautious brains:3 brains:5 advisor --rounds 4
+    python tournament.py ratings rr.zdt
+    python tournament.py check cautious advisor --sdk ~/google_appengine
+
+A strategy is a function (state, scores, seat, final_seat) -> bool that is
+asked before every roll and returns True to roll again; state is the
+engine.TurnState of the turn. Besides the built-ins below, any function can
+be named as module:function.
+
+The check mode plays games through the app's Game and Turn models on
+storage.MemoryStorage instead, and fails if any turn is scored differently
+from engine.score_turn.
+"""
+
+import argparse
+import importlib
+import json
+import multiprocessing
+import struct
+
+import advisor
+import engine
+
+# a game that outlasts this many rounds is recorded without a winner
+MAX_ROUNDS = 100
+# games a worker plays before reporting back
+CHUNK_SIZE = 500
+ELO_START = 1500.0
+ELO_K = 4.0
+
+MAGIC = b'ZDT1'
+# seat 0 strategy, seat 1 strategy, winning seat (-1 if none), the two
+# final scores and the number of turns played
+RECORD = struct.Struct('<HHbBBH')
+_HEADER = struct.Struct('<I')
+
+
+def cautious(state, scores, seat, final_seat):
+    """Rolls until the turn holds two shots"""
+    return state.shots < engine.MAX_SHOTS
+
+
+def brains(target):
+    """Returns a strategy that also stops at `target` brains"""
+    def strategy(state, scores, seat, final_seat):
+        return state.shots < engine.MAX_SHOTS and state.brains < target
+    return strategy
+
+
+def best_turn(state, scores, seat, final_seat):
+    """Rolls whenever rolling on is worth more brains than stopping, and
+    always when it is the final turn and stopping would lose"""
+    if final_seat == seat:
+        others = max(score for i, score in enumerate(scores) if i != seat)
+        if scores[seat] + state.brains <= others:
+            return True
+    bust, stop, roll = advisor.advise(state)
+    return roll > stop
+
+
+STRATEGIES = {
+    'cautious': cautious,
+    'advisor': best_turn,
+}
+
+
+def load_strategy(name):
+    """Returns the strategy for a name: a built-in, brains:N or
+    module:function"""
+    if name in STRATEGIES:
+        return STRATEGIES[name]
+    prefix, _, arg = name.partition(':')
+    if prefix == 'brains':
+        return brains(int(arg))
+    if arg:
+        return getattr(importlib.import_module(prefix), arg)
+    raise ValueError('Unknown strategy: ' + name)
+
+
+def play_game(strategies, rng):
+    """Plays a game between the strategies, one per seat.
+    Returns:
+        A (winner seat or None, scores, turns played) tuple."""
+    players = len(strategies)
+    scores = [0] * players
+    final = None
+    for turn in range(MAX_ROUNDS * players):
+        seat = turn % players
+        strategy = strategies[seat]
+        state = engine.TurnState()
+        while state.can_roll and strategy(state, scores, seat, final):
+            state.roll(rng)
+            if state.busted:
+                break
+        final, winner = engine.score_turn(
+            scores, seat, state.brains, state.shots, final)
+        if winner is not None:
+            return winner, scores, turn + 1
+    return None, scores, MAX_ROUNDS * players
+
+
+def play_app_game(strategies):
+    """Plays a game between the strategies, one per seat, through Game and
+    Turn on the current storage, checking the game after every turn against
+    engine.score_turn. Returns what play_game does"""
+    from models import Game, Turn, User
+    from models.storage import get_storage
+
+    storage = get_storage()
+    players = len(strategies)
+    names = ['seat{}'.format(seat) for seat in range(players)]
+    keys = [User.key_for(name) for name in names]
+    storage.put_multi([User(key=key, name=name)
+                       for key, name in zip(keys, names)])
+    game = Game.new_game(keys, names)
+    scores = [0] * players
+    final = None
+    for number in range(MAX_ROUNDS * players):
+        seat = number % players
+        strategy = strategies[seat]
+        turn = Turn.load(game.next_turn)
+        while not turn.turn_over and turn.state.can_roll and \
+                strategy(turn.state, scores, seat, final):
+            turn.take_turn()
+        if not turn.turn_over:
+            turn.end_turn()
+        final, winner = engine.score_turn(
+            scores, seat, turn.brains, turn.shots, final)
+        game = storage.get(game.key)
+        if game.current_scores() != scores or \
+                game.game_over != (winner is not None) or \
+                (winner is not None and game.winner != keys[winner]):
+            raise RuntimeError('Turn {} of a game was scored differently '
+                               'from engine.score_turn'.format(number))
+        if winner is not None:
+            return winner, scores, number + 1
+    return None, scores, MAX_ROUNDS * players
+
+
+def check(names, games, sdk, seed=0):
+    """Plays games between the strategies through the app's models on a
+    MemoryStorage, against the SDK's testbed for the app environment"""
+    import random
+    import time
+    import api_bench
+
+    bed = api_bench.setup(sdk)
+    from models import storage
+    try:
+        random.seed(seed)
+        strategies = [load_strategy(name) for name in names]
+        wins = [0] * len(names)
+        start = time.time()
+        for _ in range(games):
+            storage.set_storage(storage.MemoryStorage())
+            winner, _, _ = play_app_game(strategies)
+            if winner is not None:
+                wins[winner] += 1
+        elapsed = time.time() - start
+    finally:
+        storage.set_storage(storage.NdbStorage())
+        bed.deactivate()
+    for name, won in zip(names, wins):
+        print('{:<24} {:>7} wins'.format(name, won))
+    print('{} games agree with engine.score_turn ({:.0f} games/s)'.format(
+        games, games / max(elapsed, 1e-9)))
+
+
+def _play_chunk(job):
+    """Plays one chunk of a match in a worker process. Seats alternate
+    from game to game. Returns the packed records"""
+    names, ids, seed, count = job
+    strategies = [load_strategy(name) for name in names]
+    records = []
+    for i in range(count):
+        order = (0, 1) if i % 2 == 0 else (1, 0)
+        rng = engine.Rng(seed * 0x9E3779B97F4A7C15 + i)
+        winner, scores, turns = play_game(
+            [strategies[j] for j in order], rng)
+        if winner is None:
+            winner = -1
+        records.append(RECORD.pack(
+            ids[order[0]], ids[order[1]], winner,
+            min(scores[0], 255), min(scores[1], 255), min(turns, 65535)))
+    return b''.join(records)
+
+
+class Ratings(object):
+    """Elo ratings updated one game at a time"""
+
+    def __init__(self, names, k=ELO_K):
+        self.names = names
+        self.k = k
+        self.rating = [ELO_START] * len(names)
+        self.games = [0] * len(names)
+        self.wins = [0] * len(names)
+
+    def add(self, first, second, winner):
+        expected = 1.0 / (1.0 + 10 ** (
+            (self.rating[second] - self.rating[first]) / 400.0))
+        if winner == 0:
+            result = 1.0
+            self.wins[first] += 1
+        elif winner == 1:
+            result = 0.0
+            self.wins[second] += 1
+        else:
+            result = 0.5
+        self.rating[first] += self.k * (result - expected)
+        self.rating[second] -= self.k * (result - expected)
+        self.games[first] += 1
+        self.games[second] += 1
+
+    def add_records(self, data):
+        for first, second, winner, _, _, _ in _iter_records(data):
+            self.add(first, second, winner)
+
+    def report(self):
+        rows = sorted(range(len(self.names)),
+                      key=lambda i: -self.rating[i])
+        lines = ['{:<24} {:>8} {:>10} {:>7}'.format(
+            'strategy', 'elo', 'games', 'win %')]
+        for i in rows:
+            lines.append('{:<24} {:>8.1f} {:>10} {:>7.2f}'.format(
+                self.names[i], self.rating[i], self.games[i],
+                100.0 * self.wins[i] / max(self.games[i], 1)))
+        return '\n'.join(lines)
+
+
+def _iter_records(data):
+    for offset in range(0, len(data), RECORD.size):
+        yield RECORD.unpack_from(data, offset)
+
+
+class ResultsFile(object):
+    """Appends records to a results file: MAGIC, the length of a JSON
+    header naming the strategies, the header, then fixed-size records"""
+
+    def __init__(self, path, names):
+        self.file = open(path, 'wb')
+        header = json.dumps({'strategies': names}).encode('utf-8')
+        self.file.write(MAGIC + _HEADER.pack(len(header)) + header)
+
+    def write(self, data):
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+
+def read_results(path):
+    """Returns (strategy names, records) of a results file"""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(path + ' is not a tournament results file')
+        length, = _HEADER.unpack(f.read(_HEADER.size))
+        names = json.loads(f.read(length).decode('utf-8'))['strategies']
+        return names, f.read()
+
+
+def _jobs(names, pairs, games, seed):
+    """Splits every pairing into chunks of CHUNK_SIZE games"""
+    jobs = []
+    for a, b in pairs:
+        for start in range(0, games, CHUNK_SIZE):
+            jobs.append(((names[a], names[b]), (a, b),
+                         seed + len(jobs), min(CHUNK_SIZE, games - start)))
+    return jobs
+
+
+def _play(pool, jobs, ratings, out):
+    for data in pool.imap_unordered(_play_chunk, jobs):
+        ratings.add_records(data)
+        if out:
+            out.write(data)
+
+
+def round_robin(names, games, pool, ratings, out=None, seed=0):
+    """Plays `games` games between every pair of strategies"""
+    pairs = [(a, b) for a in range(len(names))
+             for b in range(a + 1, len(names))]
+    _play(pool, _jobs(names, pairs, games, seed), ratings, out)
+
+
+def swiss(names, games, rounds, pool, ratings, out=None, seed=0):
+    """Plays `rounds` rounds, each pairing strategies of similar rating
+    that have not met yet. With an odd number, the lowest sits out"""
+    met = set()
+    for number in range(rounds):
+        order = sorted(range(len(names)), key=lambda i: -ratings.rating[i])
+        pairs = []
+        while len(order) > 1:
+            a = order.pop(0)
+            rivals = [b for b in order if (min(a, b), max(a, b)) not in met]
+            b = rivals[0] if rivals else order[0]
+            order.remove(b)
+            met.add((min(a, b), max(a, b)))
+            pairs.append((a, b))
+        _play(pool, _jobs(names, pairs, games, seed + number * 100003),
+              ratings, out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('mode', choices=('round-robin', 'swiss', 'ratings',
+                                         'check'))
+    parser.add_argument('names', nargs='+',
+                        help='strategies, or a results file for ratings')
+    parser.add_argument('-n', '--games', type=int, default=10000,
+                        help='games per pairing')
+    parser.add_argument('--rounds', type=int, default=3,
+                        help='rounds of a swiss tournament')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='worker processes, all cores by default')
+    parser.add_argument('--k', type=float, default=ELO_K,
+                        help='Elo K factor')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help='write the game results here')
+    parser.add_argument('--sdk', help='path of the App Engine Python SDK, '
+                        'for check')
+    args = parser.parse_args()
+
+    if args.mode == 'check':
+        if not args.sdk:
+            parser.error('check needs --sdk')
+        check(args.names, args.games, args.sdk, args.seed)
+        return
+
+    if args.mode == 'ratings':
+        names, data = read_results(args.names[0])
+        ratings = Ratings(names, args.k)
+        ratings.add_records(data)
+        print(ratings.report())
+        return
+
+    for name in args.names:
+        load_strategy(name)  # fail early on a bad name
+    ratings = Ratings(args.names, args.k)
+    out = args.out and ResultsFile(args.out, args.names)
+    pool = multiprocessing.Pool(args.processes)
+    try:
+        if args.mode == 'round-robin':
+            round_robin(args.names, args.games, pool, ratings, out,
+                        args.seed)
+        else:
+            swiss(args.names, args.games, args.rounds, pool, ratings, out,
+                  args.seed)
+    finally:
+        pool.close()
+        pool.join()
+        if out:
+            out.close()
+    print(ratings.report())
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,27 @@
 import logging
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 import endpoints
 
+import cache
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def key_from_urlsafe(urlsafe):
+    """Returns the ndb.Key for a urlsafe key string. Raises a
+    BadRequestException if the string is malformed"""
+    try:
+        return ndb.Key(urlsafe=urlsafe)
+    except TypeError:
+        raise endpoints.BadRequestException('Invalid Key')
+    except Exception as e:
+        if e.__class__.__name__ == 'ProtocolBufferDecodeError':
+            raise endpoints.BadRequestException('Invalid Key')
+        else:
+            raise
+
 
 def get_by_urlsafe(urlsafe, model):
     """Returns an ndb.Model entity that the urlsafe key points to. Checks
@@ -13,22 +33,60 @@ def get_by_urlsafe(urlsafe, model):
         model: The expected entity kind
     Returns:
         The entity that the urlsafe Key string points to or None if no entity
-        exists.
+        exists. It may come from the read cache, see cache.py.
     Raises:
         ValueError:"""
-    try:
-        key = ndb.Key(urlsafe=urlsafe)
-    except TypeError:
-        raise endpoints.BadRequestException('Invalid Key')
-    except Exception as e:
-        if e.__class__.__name__ == 'ProtocolBufferDecodeError':
-            raise endpoints.BadRequestException('Invalid Key')
-        else:
-            raise
-
-    entity = key.get()
+    entity = cache.get(key_from_urlsafe(urlsafe))
     if not entity:
         return None
     if not isinstance(entity, model):
         raise ValueError('Incorrect Kind')
     return entity
+
+
+def get_multi_dict(keys):
+    """Fetches the entities for a list of keys with a single get_multi,
+    skipping duplicates and None.
+    Args:
+        keys: A list of ndb.Keys, possibly repeated or None
+    Returns:
+        A dict mapping each key to its entity, or to None if no entity
+        exists."""
+    keys = list(set(key for key in keys if key is not None))
+    return dict(zip(keys, ndb.get_multi(keys)))
+
+
+def page_size(size):
+    """Clamps a requested page size to 1..MAX_PAGE_SIZE, using
+    DEFAULT_PAGE_SIZE when none was given"""
+    if not size:
+        return DEFAULT_PAGE_SIZE
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def parse_cursor(urlsafe):
+    """Returns the query Cursor for a urlsafe cursor string, or None.
+    Raises a BadRequestException if the string is malformed"""
+    if not urlsafe:
+        return None
+    try:
+        return Cursor(urlsafe=urlsafe)
+    except Exception:
+        raise endpoints.BadRequestException('Invalid cursor')
+
+
+def fetch_page(query, size, cursor, **options):
+    """Fetches one page of query results.
+    Args:
+        query: An ndb.Query
+        size: The requested page size, see page_size()
+        cursor: The urlsafe cursor returned with the previous page, or None
+        options: Extra query options such as keys_only or projection
+    Returns:
+        A (results, next_cursor) tuple. next_cursor is a urlsafe string, or
+        None on the last page."""
+    results, next_cursor, more = query.fetch_page(
+        page_size(size), start_cursor=parse_cursor(cursor), **options)
+    if more and next_cursor:
+        return results, next_cursor.urlsafe()
+    return results, None